@@ -1,5 +1,11 @@
 #!/usr/bin/env python
-from construct import Adapter, Anchor, Bytes, Enum, RepeatUntil, String, Struct, Switch, UBInt32, UBInt16, UBInt8
+import struct
+
+from construct import Adapter, Anchor, Bytes, Container, Enum, RepeatUntil, String, Struct, Switch, UBInt32, UBInt16, UBInt8
+
+import instrument
+from dsstore import DSStoreError, PlistErrors
+from reader import DSStoreReader
 
 # This file contains some structures relating to Alias records.
 # http://en.wikipedia.org/wiki/Alias_(Mac_OS)#File_structure
@@ -55,8 +61,15 @@ class AliasBlobAdapter(Adapter):
     def __init__(self, subcon):
         Adapter.__init__(self, subcon)
     def _encode(self, obj, context):
-        print "_encode:", obj.AliasType
-        return obj
+        # A decoded string tag is written back from DataAsString.Data, so
+        # that editing that is enough, whatever its new length; everything
+        # else goes out as it came in
+        if "DataAsString" not in obj:
+            return obj
+        text = obj.DataAsString.Data
+        data = AliasString.build(Container(Length = len(text.encode("utf_16_be")) // 2, Data = text))
+        return Container(AliasType = obj.AliasType, AliasLength = len(data),
+                AliasData = data + b"\0" * (len(data) % 2))
     def _decode(self, obj, context):
         def decodeUTF16(obj, context):
             obj.DataAsString = AliasString.parse(obj.AliasData)
@@ -90,7 +103,18 @@ def PaddedString(name, total_length):
         Bytes("Padding", lambda env: total_length - 1 - env.Length),
         )
 
-AliasRecord = Struct("AliasRecord",
+class AliasSizeAdapter(Adapter):
+    # Works AliasSize out afresh when building, so that a tag can be edited
+    # to a different length (see AliasBlobAdapter)
+    def _encode(self, obj, context):
+        tags = sum(len(AliasItem().build(item)) for item in obj.AliasBlob)
+        obj = obj.copy()
+        obj.AliasSize = AliasHeader.size + tags + len(obj.AliasData)
+        return obj
+    def _decode(self, obj, context):
+        return obj
+
+AliasRecord = AliasSizeAdapter(Struct("AliasRecord",
         UBInt32("UserType"),        # 0 for Alias Manager
         UBInt16("AliasSize"),       # The size of the alias record
         UBInt16("RecordVersion"),   # Version of the alias record, currently 2
@@ -114,5 +138,151 @@ AliasRecord = Struct("AliasRecord",
         RepeatUntil(lambda obj, env: obj.AliasType == "END_OF_LIST", AliasItem()),
         Anchor("DataBegin"),
         Bytes("AliasData", lambda env: env.AliasSize - env.DataBegin) # The alias record data
-        )
+        ))
+
+
+# The fixed part of AliasRecord, up to the first tag, as one struct
+AliasHeader = struct.Struct(">IHHH28sIHHI64sII4s4sHHIH10s")
+AliasHeaderFields = ("UserType", "AliasSize", "RecordVersion", "AliasKind", "VolumeName",
+        "VolumeMacDate", "VolumeSignature", "VolumeType", "ParentDirID", "FileName",
+        "FileNumber", "FileMacDate", "FileType", "FileCreator", "nlvlFrom", "nlvlTo",
+        "VolumeFlags", "VolumeFSID", "Reserved")
+TagHeader = struct.Struct(">HH")
+END_OF_LIST = 0xffff
+FILENAME_UTF16 = 14
+VOLUMENAME_UTF16 = 15
+
+def _paddedString(data):
+    return data[1:1 + min(ord(data[0:1]), len(data) - 1)]
+
+class AliasView(object):
+    # A read-only view of an alias record over a memoryview.  The fixed
+    # header is unpacked up front; tags are only located the first time one
+    # is asked for, and only the tags asked for are decoded.  Field names
+    # follow AliasRecord, except that VolumeName and FileName are the bare
+    # name bytes and AliasKind and VolumeType are left as numbers.
+    __slots__ = AliasHeaderFields + ("_buf", "_index")
+
+    def __init__(self, buf, offset=0):
+        stats = instrument.collector
+        if stats is not None:
+            start = instrument.timer()
+        buf = memoryview(buf)[offset:]
+        try:
+            values = AliasHeader.unpack_from(buf)
+        except struct.error:
+            raise DSStoreError("alias record is shorter than its %d-byte header" % AliasHeader.size)
+        for name, value in zip(AliasHeaderFields, values):
+            setattr(self, name, value)
+        self.VolumeName = _paddedString(self.VolumeName)
+        self.FileName = _paddedString(self.FileName)
+        self._buf = buf[:min(self.AliasSize, len(buf))]
+        self._index = None
+        if stats is not None:
+            stats.aliasDecodes += 1
+            stats.add(instrument.PAYLOAD, instrument.timer() - start)
+
+    def _tags(self):
+        # Maps each tag type to the (offset, length) of its data; for a type
+        # that appears more than once, the first one wins
+        if self._index is None:
+            index = {}
+            buf = self._buf
+            pos = AliasHeader.size
+            while True:
+                if pos + TagHeader.size > len(buf):
+                    raise DSStoreError("alias record ends without an END_OF_LIST tag")
+                tagType, length = TagHeader.unpack_from(buf, pos)
+                pos += TagHeader.size
+                if tagType == END_OF_LIST:
+                    break
+                if pos + length > len(buf):
+                    raise DSStoreError("alias tag %d runs past the end of the record" % tagType)
+                index.setdefault(tagType, (pos, length))
+                pos += length + length % 2
+            self._index = index
+        return self._index
+
+    def tagTypes(self):
+        return sorted(self._tags())
+
+    def __contains__(self, tagType):
+        return tagType in self._tags()
+
+    def tag(self, tagType, default=None):
+        # The data of a tag, as a memoryview into the record
+        span = self._tags().get(tagType)
+        if span is None:
+            return default
+        return self._buf[span[0]:span[0] + span[1]]
+
+    def tagString(self, tagType, default=None):
+        # Decodes an AliasString (FILENAME_UTF16, VOLUMENAME_UTF16) tag
+        data = self.tag(tagType)
+        if data is None:
+            return default
+        length, = struct.unpack_from(">H", data)
+        return data[2:2 + length * 2].tobytes().decode("utf_16_be")
+
+    @property
+    def filename(self):
+        return self.tagString(FILENAME_UTF16) or self.FileName.decode("mac_roman")
+
+    @property
+    def volumeName(self):
+        return self.tagString(VOLUMENAME_UTF16) or self.VolumeName.decode("mac_roman")
+
+    def header(self):
+        return dict((name, getattr(self, name)) for name in AliasHeaderFields)
+
+    def items(self):
+        # (tag type, data bytes) for every tag, in record order
+        return [(tagType, self._buf[pos:pos + length].tobytes())
+                for tagType, (pos, length) in sorted(self._tags().items(), key=lambda item: item[1][0])]
+
+def _padded(name, total):
+    name = name[:total - 1]
+    return struct.pack(">B", len(name)) + name + b"\0" * (total - 1 - len(name))
+
+def aliasString(text):
+    # The data of a FILENAME_UTF16 or VOLUMENAME_UTF16 tag
+    data = text.encode("utf_16_be")
+    return struct.pack(">H", len(data) // 2) + data
+
+def buildAlias(header, tags):
+    # Encodes an alias record from a dict of AliasHeaderFields (VolumeName
+    # and FileName as bare bytes, AliasSize worked out here) and a list of
+    # (tag type, data) pairs, with a single pack for the header
+    parts = []
+    for tagType, data in tags:
+        parts.append(TagHeader.pack(tagType, len(data)))
+        parts.append(data)
+        if len(data) % 2:
+            parts.append(b"\0")
+    parts.append(TagHeader.pack(END_OF_LIST, 0))
+    body = b"".join(parts)
+    values = dict(header)
+    values["AliasSize"] = AliasHeader.size + len(body)
+    values["VolumeName"] = _padded(values["VolumeName"], 28)
+    values["FileName"] = _padded(values["FileName"], 64)
+    return AliasHeader.pack(*[values[name] for name in AliasHeaderFields]) + body
 
+def backgroundAliases(paths):
+    # Yields (path, record type, AliasView) for the background image alias
+    # of every folder in paths: the pict record, and backgroundImageAlias in
+    # the icvp plist.  Files that fail to parse, including a corrupt icvp
+    # plist, are skipped.
+    for path in paths:
+        try:
+            with DSStoreReader(path) as ds_store:
+                pict = ds_store.get(u".", b"pict")
+                if pict is not None:
+                    yield path, b"pict", AliasView(pict.RecordData.Blob)
+                icvp = ds_store.get(u".", b"icvp")
+                if icvp is not None:
+                    plist = icvp.RecordData.value
+                    alias = plist.get("backgroundImageAlias") if isinstance(plist, dict) else None
+                    if isinstance(alias, bytes):
+                        yield path, b"icvp", AliasView(alias)
+        except (DSStoreError, EnvironmentError) + PlistErrors:
+            continue
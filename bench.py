@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# Benchmarks the parsers against synthetic files (see synthetic.py) and
+# writes the results as JSON, so that runs from two commits can be compared.
+#
+#   python bench.py -o before.json
+#   python bench.py -o after.json
+#   python bench.py --compare before.json after.json
+#
+# For each size it times DSStoreFile.parse (which reads the header, the info
+# block and the root node only: it never follows child pointers), opening a
+# DSStoreReader, keyed lookups, full iteration through both the fast path
+# and the construct schema, and AliasRecord.parse on icvp background
+# aliases, taking the best of several runs.  Peak memory for a full
+# iteration, and the memory taken to keep every record resident as
+# Containers and as CompactRecords, are each measured in a fresh
+# interpreter (bench.py --measure), since ru_maxrss only ever goes up and a
+# forked child would start out with the parent's heap.  Along the way it
+# checks that the fast path and construct decode every node identically.
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from alias import AliasRecord
+from compactrecord import compactRecords
+from dsstore import DSStoreFile
+from reader import DSStoreReader
+from synthetic import generate
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+LOOKUPS = 1000
+
+def best(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def _iterate(path, fast):
+    with DSStoreReader(path, fast=fast) as ds_store:
+        for record in ds_store.records():
+            pass
+
+def _retain(path, compact):
+    with DSStoreReader(path) as ds_store:
+        if compact:
+            return compactRecords(ds_store.records())
+        return list(ds_store.records())
+
+# What peakMemory can measure: name -> (function, extra argument)
+MEASUREMENTS = {
+        "iterateFast": (_iterate, True),
+        "iterateConstruct": (_iterate, False),
+        "retainRecords": (_retain, False),
+        "retainCompact": (_retain, True),
+        }
+
+def _peakKB():
+    # The peak resident set size of this process, in kilobytes.  On Linux
+    # ru_maxrss carries over across exec, so a new interpreter can start out
+    # at its parent's peak; VmHWM belongs to this process image alone.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes there
+        peak //= 1024
+    return peak
+
+def _measure(measurement, path):
+    # Runs in the fresh interpreter: how far, in kilobytes, the measurement
+    # pushes up the peak resident set size
+    func, arg = MEASUREMENTS[measurement]
+    before = _peakKB()
+    result = func(path, arg)
+    return _peakKB() - before
+
+def peakMemory(measurement, path):
+    # Runs one of MEASUREMENTS on the file at path in a new interpreter
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+            "--measure", measurement, path])
+    return int(output)
+
+def checkParity(path):
+    fast = DSStoreReader(path)
+    reference = DSStoreReader(path, fast=False)
+    stack = [fast.BTreeMetadata.RootBlockNumber]
+    while stack:
+        blockNumber = stack.pop()
+        node = fast._decodeNode(blockNumber)
+        if node != reference._decodeNode(blockNumber):
+            raise AssertionError("%s: fast path and construct disagree on block %d" % (path, blockNumber))
+        if node.P:
+            stack.extend(entry.ChildBlockNumber for entry in node.BlockData)
+            stack.append(node.P)
+    fast.close()
+    reference.close()
+
+def benchSize(directory, count, repeat, constructLimit):
+    path = os.path.join(directory, "bench-%d.DS_Store" % count)
+    with open(path, "wb") as f:
+        f.write(generate(count, seed=count))
+    with open(path, "rb") as f:
+        buf = f.read()
+
+    result = {"records": count, "fileSize": len(buf)}
+    with DSStoreReader(path) as ds_store:
+        result["levels"] = ds_store.BTreeMetadata.NumLevels
+        result["nodes"] = ds_store.BTreeMetadata.NumNodes
+        records = list(ds_store.records())
+    keys = [(r.Filename, r.RecordType) for r in records]
+    aliases = [bytes(r.RecordData["backgroundImageAlias"]) for r in records
+            if r.RecordType == b"icvp" and "backgroundImageAlias" in r.RecordData]
+    rnd = random.Random(count)
+    lookups = [rnd.choice(keys) for i in range(LOOKUPS)]
+
+    def lookup():
+        with DSStoreReader(path) as ds_store:
+            for filename, recordType in lookups:
+                ds_store.get(filename, recordType)
+
+    result["parseConstructHeaderAndRoot"] = best(lambda: DSStoreFile.parse(buf), repeat)
+    result["openReader"] = best(lambda: DSStoreReader(path).close(), repeat)
+    result["lookup"] = best(lookup, repeat) / LOOKUPS
+    result["iterateFast"] = best(lambda: _iterate(path, True), repeat)
+    result["peakMemoryFastKB"] = peakMemory("iterateFast", path)
+    result["retainedRecordsKB"] = peakMemory("retainRecords", path)
+    result["retainedCompactKB"] = peakMemory("retainCompact", path)
+    if count <= constructLimit:
+        checkParity(path)
+        result["iterateConstruct"] = best(lambda: _iterate(path, False), repeat)
+        result["peakMemoryConstructKB"] = peakMemory("iterateConstruct", path)
+    if aliases:
+        result["aliasParse"] = best(lambda: [AliasRecord.parse(a) for a in aliases], repeat) / len(aliases)
+    os.remove(path)
+    return result
+
+def environment():
+    env = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            }
+    try:
+        env["commit"] = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, "w")).strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+def compare(before, after):
+    # Prints after/before for every timing and memory figure
+    old = dict((r["records"], r) for r in before["results"])
+    for result in after["results"]:
+        previous = old.get(result["records"])
+        if previous is None:
+            continue
+        for metric in sorted(result):
+            if metric in ("records", "levels", "nodes") or metric not in previous or not previous[metric]:
+                continue
+            print "%8d %-24s %12.6g -> %12.6g  x%.2f" % (result["records"], metric,
+                    previous[metric], result[metric], float(result[metric]) / previous[metric])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DS_Store parsing on synthetic files.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+            help="comma-separated record counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the best is kept")
+    parser.add_argument("--construct-limit", type=int, default=10000,
+            help="largest size to iterate through the construct schema")
+    parser.add_argument("-o", "--output", default=None, help="JSON output file (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--measure", nargs=2, metavar=("MEASUREMENT", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print _measure(*args.measure)
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after)
+        sys.exit(0)
+
+    directory = tempfile.mkdtemp(prefix="dsstore-bench-")
+    try:
+        results = []
+        for count in [int(s) for s in args.sizes.split(",")]:
+            results.append(benchSize(directory, count, args.repeat, args.construct_limit))
+            sys.stderr.write("%d records done\n" % count)
+    finally:
+        shutil.rmtree(directory)
+    report = json.dumps({"environment": environment(), "results": results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print report
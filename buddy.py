@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# The buddy allocator that manages space inside a DS_Store file.
+#
+# From http://search.cpan.org/~wiml/Mac-Finder-DSStore/DSStoreFormat.pod :
+# the allocator hands out blocks whose sizes are powers of two, aligned to
+# their own size, out of a notional 2^31-byte arena.  Free space is kept as 32
+# lists of offsets, one per power of two; a free block whose buddy (the other
+# half of the block it was split from) is also free is merged back into the
+# larger block.  Block numbers index the BlockAddresses table, whose entries
+# pack the offset and the log2 of the size together (see offsetFromAddress
+# and sizeFromAddress in dsstore.py).
+
+import struct
+from bisect import bisect_left, insort
+
+from dsstore import DSStoreError, offsetFromAddress, roundUpToNearest256
+
+MIN_WIDTH = 5  # 32 bytes; the low 5 bits of an address hold the width
+MAX_WIDTH = 31
+
+def widthForSize(size):
+    return max(MIN_WIDTH, (size - 1).bit_length())
+
+class BuddyAllocator(object):
+    def __init__(self, blockAddresses=None, freeLists=None):
+        if freeLists is None:
+            # A fresh arena: one free 2^31 block, out of which the 32 bytes
+            # at offset 0 are taken for the BuddyAllocatorHeader.
+            self.free = [[] for i in range(32)]
+            self.free[MAX_WIDTH].append(0)
+            self._allocate(MIN_WIDTH)
+        else:
+            self.free = [sorted(offsets) for offsets in freeLists]
+        self.BlockAddresses = list(blockAddresses or [])
+
+    @classmethod
+    def fromReader(cls, reader):
+        return cls(reader.BlockAddresses[:reader.NumBlocks],
+                [freeList.Offset for freeList in reader.FreeList])
+
+    def _allocate(self, width):
+        for w in range(width, MAX_WIDTH + 1):
+            if self.free[w]:
+                break
+        else:
+            raise DSStoreError("no free block of %d bytes" % (1 << width))
+        offset = self.free[w].pop(0)
+        # Split the block down to the requested size, freeing the upper half
+        # at every step
+        while w > width:
+            w -= 1
+            insort(self.free[w], offset + (1 << w))
+        return offset
+
+    def _release(self, offset, width):
+        while width < MAX_WIDTH:
+            freeList = self.free[width]
+            buddy = offset ^ (1 << width)
+            i = bisect_left(freeList, buddy)
+            if i == len(freeList) or freeList[i] != buddy:
+                break
+            del freeList[i]
+            offset &= ~(1 << width)
+            width += 1
+        insort(self.free[width], offset)
+
+    def allocate(self, size, blockNumber=None):
+        # Returns the number of a new block of at least size bytes; the
+        # caller can ask for a particular unassigned block number
+        if blockNumber is None:
+            try:
+                blockNumber = self.BlockAddresses.index(0)
+            except ValueError:
+                blockNumber = len(self.BlockAddresses)
+        elif blockNumber < len(self.BlockAddresses) and self.BlockAddresses[blockNumber]:
+            raise DSStoreError("block %d is already allocated" % blockNumber)
+        width = widthForSize(size)
+        address = self._allocate(width) | width
+        while len(self.BlockAddresses) <= blockNumber:
+            self.BlockAddresses.append(0)
+        self.BlockAddresses[blockNumber] = address
+        return blockNumber
+
+    def release(self, blockNumber):
+        address = self.BlockAddresses[blockNumber]
+        if address == 0:
+            raise DSStoreError("block %d is not allocated" % blockNumber)
+        self._release(offsetFromAddress(address), address & 0x1f)
+        self.BlockAddresses[blockNumber] = 0
+        while self.BlockAddresses and self.BlockAddresses[-1] == 0:
+            self.BlockAddresses.pop()
+
+    def end(self):
+        # The end of the highest allocated block, relative to the arena
+        ends = [offsetFromAddress(a) + (1 << (a & 0x1f)) for a in self.BlockAddresses if a]
+        return max(ends) if ends else 32
+
+def buildInfoBlock(allocator, directory, zeros=0):
+    # Lays out the BuddyAllocatorMetadata: the block address table padded to
+    # a multiple of 256 entries, the directory, then the 32 free lists.
+    addresses = allocator.BlockAddresses
+    tableLength = roundUpToNearest256(len(addresses))
+    parts = [
+            struct.pack(">II", len(addresses), zeros),
+            struct.pack(">%dI" % tableLength, *(addresses + [0] * (tableLength - len(addresses)))),
+            struct.pack(">I", len(directory)),
+            ]
+    for name in sorted(directory):
+        parts.append(struct.pack(">B", len(name)) + name + struct.pack(">I", directory[name]))
+    for freeList in allocator.free:
+        parts.append(struct.pack(">I%dI" % len(freeList), len(freeList), *freeList))
+    return b"".join(parts)
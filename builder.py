@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Builds a DS_Store file from scratch.  Rather than inserting records one at a
+# time and splitting nodes as they fill, the records are sorted once and the
+# B-tree is bulk-loaded bottom-up: leaves are packed to the page size, the
+# record falling between two leaves goes up as their separator, and each
+# level above is packed the same way until a single root is left.  The
+# buddy allocator is then laid out and the whole file written in one go.
+#
+# As in DSStoreWriter, a node that can't be cut into pieces that fit a page
+# (a record bigger than a page, or two that won't share one) is kept whole
+# in a block as big as it needs.
+
+import struct
+
+from buddy import BuddyAllocator, buildInfoBlock
+from dsstore import DSStoreError, offsetFromAddress, recordKey, roundUpToNearest256, sizeFromAddress
+from reader import ARENA_OFFSET, BTreeMetadataStruct, FileHeaderStruct
+from writer import buildRecord, makeRecord
+
+INFO_BLOCK = 0
+DSDB_BLOCK = 1
+
+def _packLevel(first, items, pageSize, extra, maxRecords=None):
+    # items are (encoded record, child after it); first is the child before
+    # the first record (None throughout for leaves).  A node is closed once
+    # it is full or holds maxRecords records.  Returns the nodes as (encoded
+    # records, children) and the separators between them.
+    nodes = []
+    separators = []
+    records, children, used = [], [first], 8
+    for record, child in items:
+        size = len(record) + extra
+        if records and (used + size > pageSize or len(records) == maxRecords):
+            nodes.append((records, children))
+            separators.append(record)
+            records, children, used = [], [child], 8
+        else:
+            # A record too big for a page still goes in, alone
+            records.append(record)
+            children.append(child)
+            used += size
+    if not records and nodes:
+        # The last item went up as a separator and left this node empty
+        prevRecords, prevChildren = nodes.pop()
+        separator = separators.pop()
+        if len(prevRecords) >= 2:
+            # The previous node gives up its last record instead
+            nodes.append((prevRecords[:-1], prevChildren[:-1]))
+            separators.append(prevRecords[-1])
+            records = [separator]
+            children = [prevChildren[-1], children[0]]
+        else:
+            # It has only the one, so the separator comes back down into it
+            # and the node outgrows the page
+            records = prevRecords + [separator]
+            children = prevChildren + children
+    nodes.append((records, children))
+    return nodes, separators
+
+def _buildNode(records, children):
+    # Like writer.buildBTreeNode, but from records that are already encoded
+    if children is None:
+        return struct.pack(">II", 0, len(records)) + b"".join(records)
+    body = [struct.pack(">I", child) + r for child, r in zip(children, records)]
+    return struct.pack(">II", children[-1], len(records)) + b"".join(body)
+
+def _records(items):
+    for item in items:
+        if isinstance(item, tuple):
+            item = makeRecord(*item)
+        yield item
+
+def bulkLoad(items, pageSize=4096, maxRecords=None):
+    # items are Record containers or (filename, recordType, value[, dataType])
+    # tuples, in any order; for duplicate keys the last one wins.  Returns
+    # the contents of the new file.  maxRecords caps the records in a node,
+    # which makes for a deeper tree at the same page size.
+    keyed = {}
+    for record in _records(items):
+        keyed[recordKey(record.Filename, record.RecordType)] = record
+    records = [keyed[key] for key in sorted(keyed)]
+
+    # Pack the tree.  Nodes are numbered in the order they are created,
+    # which is also the order the allocator will hand out their blocks.
+    encodedNodes = []
+    level = [(buildRecord(r), None) for r in records]
+    first = None
+    extra = 0
+    numLevels = 0
+    while True:
+        nodes, separators = _packLevel(first, level, pageSize, extra, maxRecords)
+        blockNumbers = []
+        for nodeRecords, children in nodes:
+            blockNumbers.append(DSDB_BLOCK + 1 + len(encodedNodes))
+            encodedNodes.append((nodeRecords, None if first is None else children))
+        if len(nodes) == 1:
+            break
+        first = blockNumbers[0]
+        level = list(zip(separators, blockNumbers[1:]))
+        extra = 4
+        numLevels += 1
+    root = blockNumbers[0]
+
+    # The info block holds the block table, the DSDB directory entry and at
+    # most one free block per size, since nothing is ever freed here
+    numBlocks = DSDB_BLOCK + 1 + len(encodedNodes)
+    infoSize = 8 + 4 * roundUpToNearest256(numBlocks) + 4 + 9 + 32 * 8
+    allocator = BuddyAllocator()
+    if allocator.allocate(infoSize) != INFO_BLOCK or allocator.allocate(20) != DSDB_BLOCK:
+        raise DSStoreError("fresh allocator handed out unexpected block numbers")
+    blocks = {
+            DSDB_BLOCK: BTreeMetadataStruct.pack(root, numLevels, len(records), len(encodedNodes), pageSize),
+            }
+    for blockNumber, (nodeRecords, children) in enumerate(encodedNodes, DSDB_BLOCK + 1):
+        data = _buildNode(nodeRecords, children)
+        if allocator.allocate(max(len(data), pageSize)) != blockNumber:
+            raise DSStoreError("fresh allocator handed out unexpected block numbers")
+        blocks[blockNumber] = data
+    blocks[INFO_BLOCK] = buildInfoBlock(allocator, {b"DSDB": DSDB_BLOCK})
+
+    infoAddress = allocator.BlockAddresses[INFO_BLOCK]
+    out = bytearray(ARENA_OFFSET + allocator.end())
+    out[0:FileHeaderStruct.size] = FileHeaderStruct.pack(1, b"Bud1",
+            offsetFromAddress(infoAddress), sizeFromAddress(infoAddress),
+            offsetFromAddress(infoAddress), b"\0" * 16)
+    for blockNumber, data in blocks.items():
+        start = ARENA_OFFSET + offsetFromAddress(allocator.BlockAddresses[blockNumber])
+        out[start:start + len(data)] = data
+    return bytes(out)
+
+def writeDSStore(path, items, pageSize=4096):
+    data = bulkLoad(items, pageSize)
+    with open(path, "wb") as f:
+        f.write(data)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# An on-disk cache of parsed DS_Store files, for scans that keep coming back
+# to the same, mostly unchanged, files.  Entries live in a SQLite database and
+# are keyed on (path, size, mtime); with verify=True a hash of the allocator
+# header and info block must match as well.  The records are stored in their
+# on-disk encoding, which is compact and comes back through the fastparse
+# decoder without touching construct.  Least recently used entries are
+# evicted once the cache grows past maxBytes.
+#
+# Several processes can share a cache, so a lookup must not leave the
+# database locked.  Hits only note their place in the LRU order in memory;
+# the notes are written out with the next put() or at close().
+
+import hashlib
+import os
+import sqlite3
+
+from fastparse import parseRecord
+from reader import ARENA_OFFSET, DSStoreReader, FileHeaderStruct
+from writer import buildRecord
+
+CACHE_FILENAME = "dsstore-cache.sqlite"
+
+def headerFingerprint(path):
+    # A hash of the BuddyAllocatorHeader and the info block it points at.
+    # This catches most rewrites that leave size and mtime alone, though
+    # not an in-place edit of a single node.
+    with open(path, "rb") as f:
+        header = f.read(FileHeaderStruct.size)
+        digest = hashlib.sha1(header)
+        if len(header) == FileHeaderStruct.size:
+            fields = FileHeaderStruct.unpack(header)
+            f.seek(ARENA_OFFSET + fields[2])
+            digest.update(f.read(fields[3]))
+    return digest.hexdigest()
+
+class CacheStats(object):
+    __slots__ = ("hits", "misses", "stale", "evictions")
+
+    def __init__(self):
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __repr__(self):
+        return "CacheStats(hits=%d, misses=%d, stale=%d, evictions=%d)" % (
+                self.hits, self.misses, self.stale, self.evictions)
+
+class ParseCache(object):
+    def __init__(self, directory, maxBytes=256 * 1024 * 1024, verify=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.maxBytes = maxBytes
+        self.verify = verify
+        self.stats = CacheStats()
+        self._db = sqlite3.connect(os.path.join(directory, CACHE_FILENAME), timeout=30)
+        self._db.text_factory = str
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                fingerprint TEXT,
+                count INTEGER,
+                data BLOB,
+                used INTEGER)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self._db.commit()
+        total, clock = self._db.execute("SELECT SUM(LENGTH(data)), MAX(used) FROM entries").fetchone()
+        self._bytes = total or 0
+        self._clock = clock or 0
+        # path -> clock of its last hit, not yet written out
+        self._used = {}
+
+    def close(self):
+        if self._db is not None:
+            self._writeUsed()
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _writeUsed(self):
+        # Part of the caller's transaction, which the caller commits
+        if self._used:
+            self._db.executemany("UPDATE entries SET used = ? WHERE path = ?",
+                    [(used, path) for path, used in self._used.items()])
+            self._used = {}
+
+    def get(self, path, st=None):
+        # Returns the cached records for path, or None if there are none or
+        # the file has changed since they were stored
+        if st is None:
+            st = os.stat(path)
+        row = self._db.execute("SELECT size, mtime, fingerprint, count, data FROM entries WHERE path = ?",
+                (path,)).fetchone()
+        if row is None:
+            self.stats.misses += 1
+            return None
+        size, mtime, fingerprint, count, data = row
+        if (size != st.st_size or mtime != st.st_mtime or
+                (self.verify and fingerprint != headerFingerprint(path))):
+            self.stats.misses += 1
+            self.stats.stale += 1
+            return None
+        self._used[path] = self._tick()
+        self.stats.hits += 1
+        data = bytes(data)
+        records = []
+        pos = 0
+        for i in range(count):
+            record, pos = parseRecord(data, pos)
+            records.append(record)
+        return records
+
+    def put(self, path, records, st=None):
+        if st is None:
+            st = os.stat(path)
+        data = b"".join(buildRecord(r) for r in records)
+        self._writeUsed()
+        old = self._db.execute("SELECT LENGTH(data) FROM entries WHERE path = ?", (path,)).fetchone()
+        if old is not None:
+            self._bytes -= old[0]
+        self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, headerFingerprint(path) if self.verify else None,
+                len(records), sqlite3.Binary(data), self._tick()))
+        self._bytes += len(data)
+        self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        while self._bytes > self.maxBytes:
+            row = self._db.execute("SELECT path, LENGTH(data) FROM entries ORDER BY used LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM entries WHERE path = ?", (row[0],))
+            self._bytes -= row[1]
+            self.stats.evictions += 1
+
+    def records(self, path):
+        # The records of path in key order, from the cache if it is current
+        st = os.stat(path)
+        records = self.get(path, st)
+        if records is None:
+            with DSStoreReader(path) as ds_store:
+                records = list(ds_store.records())
+            self.put(path, records, st)
+        return records
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Columnar export of the fixed-layout blob records (Iloc, fwi0, icgo, icsp,
+# lssp, dilc) into NumPy arrays, for analytics over many files at once.
+#
+# Rather than building a Record for every entry, the B-tree is walked with
+# fastparse.recordSpans and the blobs of the wanted types are sliced straight
+# out of the file and joined into one buffer per type, which numpy then
+# reinterprets with a big-endian structured dtype.  The only per-record
+# Python work left is the slicing and, if asked for, decoding filenames.
+#
+# This needs numpy, which the rest of the package does not.
+
+import numpy
+
+from dsstore import DSStoreError
+from fastparse import UInt32, recordSpans
+from reader import DSStoreReader
+
+# Field layouts; see the comments on the record types in dsstore.py
+Layouts = {
+        b"Iloc": numpy.dtype([("x", ">u4"), ("y", ">u4"), ("unknown", "V8")]),
+        b"fwi0": numpy.dtype([("top", ">u2"), ("left", ">u2"), ("bottom", ">u2"), ("right", ">u2"),
+                ("view", "S4"), ("unknown", "V4")]),
+        b"icgo": numpy.dtype([("unknown1", ">u4"), ("unknown2", ">u4")]),
+        b"icsp": numpy.dtype([("unknown1", ">u4"), ("unknown2", ">u4")]),
+        b"lssp": numpy.dtype([("unknown1", ">u4"), ("unknown2", ">u4")]),
+        # Bytes 16-23 appear to hold the desktop icon position
+        b"dilc": numpy.dtype([("unknown1", "V16"), ("x", ">u4"), ("y", ">u4"), ("unknown2", "V8")]),
+        }
+
+def _collect(ds_store, fileIndex, wanted):
+    # Appends (filename bytes, blob bytes, file index) for every blob record
+    # of a wanted type and the right size to wanted[recordType]
+    buf = ds_store._buf
+    stack = [ds_store.BTreeMetadata.RootBlockNumber]
+    visited = 0
+    while stack:
+        visited += 1
+        if visited > ds_store.NumBlocks:
+            raise DSStoreError("B-tree has more nodes than there are blocks")
+        start, size = ds_store.block(stack.pop())
+        p, entries = recordSpans(buf, start)
+        if p:
+            stack.append(p)
+        for child, nameStart, nameLength, recordType, dataType, pos in entries:
+            if child is not None:
+                stack.append(child)
+            if dataType != b"blob" or recordType not in wanted:
+                continue
+            names, blobs, files, itemsize = wanted[recordType]
+            if UInt32.unpack_from(buf, pos)[0] != itemsize:
+                continue
+            names.append(buf[nameStart:nameStart + nameLength * 2])
+            blobs.append(buf[pos + 4:pos + 4 + itemsize])
+            files.append(fileIndex)
+
+def blobColumns(ds_stores, recordTypes=None, filenames=True):
+    # Returns {recordType: {column: array}} over a sequence of
+    # DSStoreReaders.  Each record type gets one column per field of its
+    # layout, a "file" column indexing ds_stores and, unless filenames is
+    # False, an object array of "filename"s.  Rows follow the B-tree's
+    # block order rather than key order, and blobs whose length doesn't
+    # match the layout are left out.
+    recordTypes = Layouts.keys() if recordTypes is None else recordTypes
+    wanted = dict((recordType, ([], [], [], Layouts[recordType].itemsize)) for recordType in recordTypes)
+    if isinstance(ds_stores, DSStoreReader):
+        ds_stores = [ds_stores]
+    for fileIndex, ds_store in enumerate(ds_stores):
+        _collect(ds_store, fileIndex, wanted)
+
+    result = {}
+    for recordType, (names, blobs, files, itemsize) in wanted.items():
+        data = numpy.frombuffer(b"".join(blobs), dtype=Layouts[recordType])
+        columns = dict((name, data[name]) for name in data.dtype.names)
+        columns["file"] = numpy.array(files, dtype=numpy.uint32)
+        if filenames:
+            column = numpy.empty(len(names), dtype=object)
+            column[:] = [name.decode("utf_16_be") for name in names]
+            columns["filename"] = column
+        result[recordType] = columns
+    return result
+
+def fileColumns(paths, recordTypes=None, filenames=True):
+    # blobColumns over a list of paths, opening one file at a time
+    def readers():
+        for path in paths:
+            with DSStoreReader(path) as ds_store:
+                yield ds_store
+    return blobColumns(readers(), recordTypes, filenames)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# A small in-memory form of Record for keeping many files' records resident.
+#
+# A parsed Record is a Container (a dict with a key-order list) holding
+# FilenameLength, the filename, RecordType, DataType and another Container
+# for the payload, about 1KB a record all told.  CompactRecord keeps four
+# slots: the filename, shared between every record that has it; the
+# RecordType and DataType codes packed into integers, which are shared too;
+# and the payload as a plain value (see writer.makeRecord), with plists
+# left as LazyPlists.  That comes to about a quarter of the memory.
+
+import struct
+
+from dsstore import LazyPlist, recordKey
+from fastparse import DataTypeNames
+from writer import DataTypeCodes, makeRecord
+
+FourCC = struct.Struct(">I")
+
+# One int object per code seen, so that records share them
+_codes = {}
+
+def packCode(code):
+    # A four-character code as a 32-bit integer
+    packed = _codes.get(code)
+    if packed is None:
+        packed = _codes.setdefault(code, FourCC.unpack(code)[0])
+    return packed
+
+def unpackCode(packed):
+    return FourCC.pack(packed)
+
+def _value(record):
+    data = record.RecordData
+    dataType = record.DataType
+    if isinstance(data, LazyPlist):
+        return data
+    if dataType == "BLOB":
+        return data.Blob
+    if dataType == "USTR":
+        return data.Data
+    if dataType == "TYPE":
+        return intern(data.RecordType)
+    if dataType == "DUTC":
+        return data.Ticks
+    return data.Value
+
+class CompactRecord(object):
+    __slots__ = ("Filename", "Code", "DataCode", "Value")
+
+    def __init__(self, filename, code, dataCode, value):
+        self.Filename = filename
+        self.Code = code
+        self.DataCode = dataCode
+        self.Value = value
+
+    @classmethod
+    def fromRecord(cls, record, names=None):
+        # names, if given, is a dict used to share equal filenames between
+        # records; pass the same one for every file kept in memory
+        filename = record.Filename
+        if names is not None:
+            filename = names.setdefault(filename, filename)
+        return cls(filename, packCode(record.RecordType),
+                packCode(DataTypeCodes[record.DataType]), _value(record))
+
+    @property
+    def RecordType(self):
+        return unpackCode(self.Code)
+
+    @property
+    def DataType(self):
+        return DataTypeNames[unpackCode(self.DataCode)]
+
+    def key(self):
+        return recordKey(self.Filename, self.RecordType)
+
+    def toRecord(self):
+        return makeRecord(self.Filename, self.RecordType, self.Value, unpackCode(self.DataCode))
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactRecord) and self.Filename == other.Filename and
+                self.Code == other.Code and self.DataCode == other.DataCode and self.Value == other.Value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "CompactRecord(%r, %r, %r, %r)" % (self.Filename, self.RecordType, self.DataType, self.Value)
+
+def compactRecords(records, names=None):
+    # Converts an iterable of Records, e.g. DSStoreReader.records(), to a
+    # list of CompactRecords
+    if names is None:
+        names = {}
+    fromRecord = CompactRecord.fromRecord
+    return [fromRecord(record, names) for record in records]
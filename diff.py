@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Structural diff of two DS_Store files, and a three-way merge.
+#
+#   python diff.py OLD NEW                    one JSON line per change
+#   python diff.py --merge BASE OURS THEIRS OUT
+#
+# Both B-trees are walked in key order side by side, as a sorted merge.  Each
+# tree is seen as a sequence of leaves and of the separator records from the
+# internal nodes between them.  Whenever both walks are at the start of a
+# leaf and the two leaves hold the same bytes, the pair is skipped without
+# decoding a record; files edited in place (see writer.py) leave every leaf
+# they didn't touch byte-for-byte alone.  Otherwise the leaves are decoded
+# and their records merged, until both walks line up on a leaf boundary
+# again.  Records compare with LazyPlist payloads left undecoded, which
+# compare by their bytes first.
+
+import json
+import sys
+from collections import deque
+
+from builder import writeDSStore
+from dsstore import DSStoreError, recordKey
+from fastparse import NodeHeader, nodeLength
+from reader import DSStoreReader
+from scanner import recordToJSON
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+def _segments(ds_store):
+    # Yields (block number, None) for each leaf and (None, record) for each
+    # separator record, in key order.  Leaves are told apart by the P in
+    # their header, so that only internal nodes get decoded here.
+    stack = []
+    blockNumber = ds_store.BTreeMetadata.RootBlockNumber
+    while True:
+        if len(stack) > ds_store.BTreeMetadata.NumLevels:
+            raise DSStoreError("B-tree is deeper than NumLevels (%d)" % ds_store.BTreeMetadata.NumLevels)
+        start, size = ds_store.block(blockNumber)
+        if NodeHeader.unpack_from(ds_store._buf, start)[0]:
+            node, records, children, keys = ds_store._entry(blockNumber)
+            stack.append((records, children, 0))
+            blockNumber = children[0]
+            continue
+        yield blockNumber, None
+        while stack:
+            records, children, i = stack.pop()
+            if i < len(records):
+                yield None, records[i]
+                stack.append((records, children, i + 1))
+                blockNumber = children[i + 1]
+                break
+        else:
+            return
+
+class _Walk(object):
+    # One side of the merge: the leaf at the front, if it hasn't been
+    # decoded, or the decoded records waiting to be compared
+    def __init__(self, ds_store):
+        self.ds_store = ds_store
+        self.segments = _segments(ds_store)
+        self.leaf = None
+        self.pending = deque()
+        self.done = False
+
+    def fill(self):
+        if self.leaf is not None or self.pending or self.done:
+            return
+        for blockNumber, record in self.segments:
+            if record is not None:
+                self.pending.append(record)
+            else:
+                start, size = self.ds_store.block(blockNumber)
+                self.leaf = (blockNumber, start, self.ds_store._buf[start:start + size])
+            return
+        self.done = True
+
+    def expand(self):
+        if self.leaf is not None:
+            self.pending.extend(self.ds_store._entry(self.leaf[0])[1])
+            self.leaf = None
+
+    def next(self):
+        # The next record, or None at the end, decoding a leaf if need be
+        while not self.pending:
+            self.fill()
+            if self.done:
+                return None
+            self.expand()
+        return self.pending[0]
+
+def _sameLeaf(a, b):
+    # Whole blocks are compared first, since that's nearly free; failing
+    # that, the bytes the nodes actually use, as whatever follows them in
+    # the block means nothing
+    if a.leaf[2] == b.leaf[2]:
+        return True
+    return (a.leaf[2][:nodeLength(a.ds_store._buf, a.leaf[1])] ==
+            b.leaf[2][:nodeLength(b.ds_store._buf, b.leaf[1])])
+
+def _same(a, b):
+    return a.DataType == b.DataType and a.RecordData == b.RecordData
+
+def diff(old, new):
+    # Yields (ADDED, key, None, record), (REMOVED, key, record, None) and
+    # (CHANGED, key, old record, new record) in key order, where key is the
+    # recordKey.  old and new are DSStoreReaders; decodePlists=False on
+    # both keeps plist payloads as plain blobs.
+    a = _Walk(old)
+    b = _Walk(new)
+    while True:
+        a.fill()
+        b.fill()
+        if a.leaf is not None and b.leaf is not None and _sameLeaf(a, b):
+            a.leaf = b.leaf = None
+            continue
+        ra = a.next()
+        rb = b.next()
+        if ra is None and rb is None:
+            return
+        ka = None if ra is None else recordKey(ra.Filename, ra.RecordType)
+        kb = None if rb is None else recordKey(rb.Filename, rb.RecordType)
+        if rb is None or (ra is not None and ka < kb):
+            a.pending.popleft()
+            yield REMOVED, ka, ra, None
+        elif ra is None or kb < ka:
+            b.pending.popleft()
+            yield ADDED, kb, None, rb
+        else:
+            a.pending.popleft()
+            b.pending.popleft()
+            if not _same(ra, rb):
+                yield CHANGED, ka, ra, rb
+
+def merge(base, ours, theirs, outPath, prefer="ours"):
+    # Three-way merge of DSStoreReaders into a new file at outPath: the
+    # changes theirs made to base are applied on top of ours.  Where both
+    # sides changed a record differently the prefer side wins.  Returns the
+    # keys of those conflicts.
+    ourChanges = dict((key, new) for kind, key, old, new in diff(base, ours))
+    theirChanges = dict((key, new) for kind, key, old, new in diff(base, theirs))
+    conflicts = []
+    for key, new in theirChanges.items():
+        if key not in ourChanges:
+            continue
+        mine = ourChanges[key]
+        if mine is None or new is None:
+            agree = mine is new
+        else:
+            agree = _same(mine, new)
+        if not agree:
+            conflicts.append(key)
+        if agree or prefer == "ours":
+            del theirChanges[key]
+    records = [record for record in ours.records()
+            if recordKey(record.Filename, record.RecordType) not in theirChanges]
+    records.extend(record for record in theirChanges.values() if record is not None)
+    writeDSStore(outPath, records, ours.BTreeMetadata.PageSize)
+    return sorted(conflicts)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--merge":
+        base, ours, theirs = [DSStoreReader(path, decodePlists=False) for path in args[1:4]]
+        for key in merge(base, ours, theirs, args[4]):
+            sys.stderr.write("conflict: %r, kept ours\n" % (key,))
+    else:
+        old, new = [DSStoreReader(path, decodePlists=False) for path in args[:2]]
+        for kind, key, a, b in diff(old, new):
+            record = b if a is None else a
+            change = {"change": kind, "filename": record.Filename, "type": record.RecordType}
+            if a is not None:
+                change["old"] = recordToJSON(a)["value"]
+            if b is not None:
+                change["new"] = recordToJSON(b)["value"]
+            print json.dumps(change, sort_keys=True)
@@ -9,10 +9,15 @@
 # Many of the comments in this code were lifted from that reference.
 
 import biplist
-from construct import Adapter, Anchor, Array, Bytes, Enum, Pointer, RepeatUntil, String, Struct, Switch, UBInt64, UBInt32, UBInt16, UBInt8
+
+import instrument
+from construct import Adapter, Anchor, Array, Bytes, Container, Enum, Pointer, RepeatUntil, String, Struct, Switch, UBInt64, UBInt32, UBInt16, UBInt8
 
 # This file contains a bunch of things related to the structure of a DS_Store file.
 
+class DSStoreError(Exception):
+    pass
+
 RecordType = Enum(Bytes("RecordType", 4),
         BKGD = 'BKGD', # 12-byte blob, directories only.  Three possible subtypes.
         ICVO = 'ICVO', # bool, directories only.
@@ -85,13 +90,85 @@ def BPlistData():
             blobData
             )
 
+# What biplist raises on a corrupt plist.  It lets the UnicodeDecodeError
+# from a malformed string through as it is.
+PlistErrors = (biplist.InvalidPlistException, biplist.NotBinaryPlistException, UnicodeDecodeError)
+
+_undecoded = object()
+
+class LazyPlist(object):
+    # A binary plist payload that keeps the raw Blob and only hands it to
+    # biplist the first time something looks inside.  The decoded value is
+    # kept, so each record pays for biplist at most once.  Once decoded the
+    # value may have been edited, so from then on it, not Blob, is what gets
+    # written back (see encode).
+    __slots__ = ("Blob", "_value")
+    def __init__(self, blob):
+        self.Blob = blob
+        self._value = _undecoded
+    @property
+    def value(self):
+        if self._value is _undecoded:
+            stats = instrument.collector
+            if stats is None:
+                self._value = biplist.readPlistFromString(self.Blob)
+            else:
+                start = instrument.timer()
+                self._value = biplist.readPlistFromString(self.Blob)
+                stats.plistDecodes += 1
+                stats.add(instrument.PAYLOAD, instrument.timer() - start)
+        return self._value
+    @property
+    def decoded(self):
+        return self._value is not _undecoded
+    def __getitem__(self, key):
+        return self.value[key]
+    def __contains__(self, key):
+        return key in self.value
+    def __iter__(self):
+        return iter(self.value)
+    def __len__(self):
+        return len(self.value)
+    def get(self, key, default=None):
+        return self.value.get(key, default)
+    def keys(self):
+        return self.value.keys()
+    def items(self):
+        return self.value.items()
+    def values(self):
+        return self.value.values()
+    def encode(self):
+        # The plist as bytes: Blob as it was read, unless it has been decoded
+        if self._value is _undecoded:
+            return self.Blob
+        return biplist.writePlistToString(self._value)
+    def __eq__(self, other):
+        if isinstance(other, LazyPlist):
+            # Identical bytes decode identically, so undecoded payloads are
+            # compared as bytes; a decoded one may have been edited since
+            if not self.decoded and not other.decoded and self.Blob == other.Blob:
+                return True
+            return self.value == other.value
+        return self.value == other
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None
+    def __repr__(self):
+        if self.decoded:
+            return repr(self._value)
+        return "LazyPlist(<%d bytes>)" % len(self.Blob)
+
 class BPlistAdapter(Adapter):
     def __init__(self, subcon):
         Adapter.__init__(self, subcon)
     def _encode(self, obj, context):
-        return biplist.writePlistToString(obj.Blob)
+        if isinstance(obj, LazyPlist):
+            blob = obj.encode()
+        else:
+            blob = biplist.writePlistToString(obj)
+        return Container(Length = len(blob), Blob = blob)
     def _decode(self, obj, context):
-        return biplist.readPlistFromString(obj.Blob)
+        return LazyPlist(obj.Blob)
 
 DataType = Enum(Bytes("DataType", 4),
         LONG = 'long', # 'long' - integer (four bytes)
@@ -190,6 +267,11 @@ Record = Struct("Record",
             }),
         )
 
+# Records are kept in the B-tree sorted by filename, compared
+# case-insensitively, and then by record type.
+def recordKey(filename, recordType):
+    return (filename.lower(), recordType)
+
 BuddyAllocatorHeader = Struct("BuddyAllocatorHeader",
         Bytes("Magic", 4),          # 0x42756431 'Bud1'
         UBInt32("InfoBlockOffset"), # "Offset to the allocator's bookkeeping information block"
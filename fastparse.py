@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# A hand-written decoder for Record and BTreeNode.  Going through construct's
+# Struct/Switch/Enum machinery for every record is very slow; this does the
+# same job with precompiled struct unpackers and a table keyed on the DataType
+# code.  It produces the same Containers as the definitions in dsstore.py,
+# which remain the reference (and what DSStoreReader falls back to with
+# fast=False).
+
+import codecs
+import gc
+import struct
+
+from construct import Container, ListContainer
+
+from dsstore import DSStoreError, LazyPlist
+
+UInt8 = struct.Struct(">B")
+UInt32 = struct.Struct(">I")
+UInt64 = struct.Struct(">Q")
+NodeHeader = struct.Struct(">II")
+RecordCodes = struct.Struct(">4s4s")
+# Skips the codec registry lookup that str.decode does on every call
+_utf16 = codecs.utf_16_be_decode
+
+# Records whose blob holds a binary plist; BPlistAdapter in dsstore.Record
+PlistRecordTypes = frozenset([b"bwsp", b"icvp", b"lsvp", b"lsvP"])
+
+# DataType codes to the names the DataType Enum decodes them to
+DataTypeNames = {
+        b"long": "LONG",
+        b"shor": "SHOR",
+        b"bool": "BOOL",
+        b"blob": "BLOB",
+        b"type": "TYPE",
+        b"ustr": "USTR",
+        b"comp": "COMP",
+        b"dutc": "DUTC",
+        }
+
+# Container(**kw) goes through Container.__setitem__ once per field.  The
+# decoders below make the same Containers several times faster by filling
+# the dict directly, with the key-order list written out as a literal.
+_newContainer = Container.__new__
+_setFieldOrder = Container.__keys_order__.__set__
+_fill = dict.__init__
+_unpackUInt8 = UInt8.unpack_from
+_unpackUInt32 = UInt32.unpack_from
+_unpackUInt64 = UInt64.unpack_from
+_unpackCodes = RecordCodes.unpack_from
+
+# Each of these decodes the value at pos and returns (RecordData, new pos)
+
+def _long(buf, pos, recordType):
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Value"])
+    _fill(c, Value=_unpackUInt32(buf, pos)[0])
+    return c, pos + 4
+
+def _bool(buf, pos, recordType):
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Value"])
+    _fill(c, Value=_unpackUInt8(buf, pos)[0])
+    return c, pos + 1
+
+def _blob(buf, pos, recordType):
+    length, = _unpackUInt32(buf, pos)
+    end = pos + 4 + length
+    blob = buf[pos + 4:end]
+    if recordType in PlistRecordTypes:
+        return LazyPlist(blob), end
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Length", "Blob"])
+    _fill(c, Length=length, Blob=blob)
+    return c, end
+
+def _type(buf, pos, recordType):
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["RecordType"])
+    _fill(c, RecordType=buf[pos:pos + 4])
+    return c, pos + 4
+
+def _ustr(buf, pos, recordType):
+    length, = _unpackUInt32(buf, pos)
+    end = pos + 4 + length * 2
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Length", "Data"])
+    _fill(c, Length=length, Data=_utf16(buf[pos + 4:end], "strict", True)[0])
+    return c, end
+
+def _comp(buf, pos, recordType):
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Value"])
+    _fill(c, Value=_unpackUInt64(buf, pos)[0])
+    return c, pos + 8
+
+def _dutc(buf, pos, recordType):
+    c = _newContainer(Container)
+    _setFieldOrder(c, ["Ticks"])
+    _fill(c, Ticks=_unpackUInt64(buf, pos)[0])
+    return c, pos + 8
+
+DataDecoders = {
+        b"long": _long,
+        b"shor": _long, # stored as four bytes, like long
+        b"bool": _bool,
+        b"blob": _blob,
+        b"type": _type,
+        b"ustr": _ustr,
+        b"comp": _comp,
+        b"dutc": _dutc,
+        }
+
+def _unknownDataType(buf, end, filename):
+    recordType, dataType = _unpackCodes(buf, end)
+    return DSStoreError("unknown data type %r in %r record for %r" % (dataType, recordType, filename))
+
+def parseRecord(buf, pos=0):
+    # Returns (Record, position just past it)
+    filenameLength, = _unpackUInt32(buf, pos)
+    pos += 4
+    end = pos + filenameLength * 2
+    filename = _utf16(buf[pos:end], "strict", True)[0]
+    recordType, dataType = _unpackCodes(buf, end)
+    try:
+        decoder = DataDecoders[dataType]
+    except KeyError:
+        raise _unknownDataType(buf, end, filename)
+    recordData, pos = decoder(buf, end + 8, recordType)
+    record = _newContainer(Container)
+    _setFieldOrder(record, ["FilenameLength", "Filename", "RecordType", "DataType", "RecordData"])
+    _fill(record, FilenameLength=filenameLength, Filename=filename, RecordType=recordType,
+            DataType=DataTypeNames[dataType], RecordData=recordData)
+    return record, pos
+
+def parseBTreeNode(buf, pos=0, end=None):
+    # Decodes the node at pos.  end bounds the block it lives in, so that a
+    # bad count fails instead of reading on into the next block.  The loop
+    # is parseRecord inlined, with _blob inlined again for the blobs that
+    # aren't plists (most of them, as Iloc is), since the calls are a good
+    # part of the time taken on a record.  The cyclic garbage collector is
+    # paused meanwhile: it would otherwise run every 700 or so Containers,
+    # and none of these can form a cycle.
+    if end is None:
+        end = len(buf)
+    decoders = DataDecoders
+    plistRecordTypes = PlistRecordTypes
+    names = DataTypeNames
+    unpackUInt32 = _unpackUInt32
+    unpackCodes = _unpackCodes
+    utf16 = _utf16
+    newContainer = _newContainer
+    setFieldOrder = _setFieldOrder
+    fill = _fill
+    collecting = gc.isenabled()
+    if collecting:
+        gc.disable()
+    try:
+        p, count = NodeHeader.unpack_from(buf, pos)
+        pos += 8
+        blockData = ListContainer()
+        append = blockData.append
+        for i in xrange(count):
+            if p:
+                child, = unpackUInt32(buf, pos)
+                pos += 4
+            filenameLength, = unpackUInt32(buf, pos)
+            pos += 4
+            nameEnd = pos + filenameLength * 2
+            filename = utf16(buf[pos:nameEnd], "strict", True)[0]
+            recordType, dataType = unpackCodes(buf, nameEnd)
+            if dataType == b"blob" and recordType not in plistRecordTypes:
+                length, = unpackUInt32(buf, nameEnd + 8)
+                pos = nameEnd + 12 + length
+                recordData = newContainer(Container)
+                setFieldOrder(recordData, ["Length", "Blob"])
+                fill(recordData, Length=length, Blob=buf[nameEnd + 12:pos])
+            else:
+                try:
+                    decoder = decoders[dataType]
+                except KeyError:
+                    raise _unknownDataType(buf, nameEnd, filename)
+                recordData, pos = decoder(buf, nameEnd + 8, recordType)
+            record = newContainer(Container)
+            setFieldOrder(record, ["FilenameLength", "Filename", "RecordType", "DataType", "RecordData"])
+            fill(record, FilenameLength=filenameLength, Filename=filename, RecordType=recordType,
+                    DataType=names[dataType], RecordData=recordData)
+            if p:
+                entry = newContainer(Container)
+                setFieldOrder(entry, ["ChildBlockNumber", "Record"])
+                fill(entry, ChildBlockNumber=child, Record=record)
+                append(entry)
+            else:
+                append(record)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise DSStoreError("corrupt B-tree node: %s" % e)
+    finally:
+        if collecting:
+            gc.enable()
+    if pos > end:
+        raise DSStoreError("B-tree node runs %d bytes past the end of its block" % (pos - end))
+    node = newContainer(Container)
+    setFieldOrder(node, ["P", "Count", "BlockData"])
+    fill(node, P=p, Count=count, BlockData=blockData)
+    return node
+
+# Encoded sizes of the data types that don't carry their own length
+FixedDataSizes = {
+        b"long": 4,
+        b"shor": 4,
+        b"bool": 1,
+        b"type": 4,
+        b"comp": 8,
+        b"dutc": 8,
+        }
+
+def nodeLength(buf, pos=0):
+    # The number of bytes the node at pos takes up, found by stepping over
+    # its records without decoding them
+    start = pos
+    try:
+        p, count = NodeHeader.unpack_from(buf, pos)
+        pos += 8
+        for i in range(count):
+            if p:
+                pos += 4
+            filenameLength, = UInt32.unpack_from(buf, pos)
+            pos += 4 + filenameLength * 2 + 8
+            dataType = buf[pos - 4:pos]
+            if dataType == b"blob":
+                pos += 4 + UInt32.unpack_from(buf, pos)[0]
+            elif dataType == b"ustr":
+                pos += 4 + UInt32.unpack_from(buf, pos)[0] * 2
+            else:
+                pos += FixedDataSizes[dataType]
+    except (struct.error, KeyError) as e:
+        raise DSStoreError("corrupt B-tree node: %s" % e)
+    return pos - start
+
+def recordSpans(buf, pos=0):
+    # Locates the records of the node at pos without decoding them.  Returns
+    # (P, entries), with one (child block number or None, filename offset,
+    # filename length in code units, RecordType, DataType, data offset) per
+    # record; for blob and ustr the data offset points at the length word.
+    try:
+        p, count = NodeHeader.unpack_from(buf, pos)
+        pos += 8
+        entries = []
+        for i in range(count):
+            child = None
+            if p:
+                child, = UInt32.unpack_from(buf, pos)
+                pos += 4
+            filenameLength, = UInt32.unpack_from(buf, pos)
+            nameStart = pos + 4
+            pos = nameStart + filenameLength * 2
+            recordType, dataType = RecordCodes.unpack_from(buf, pos)
+            pos += 8
+            entries.append((child, nameStart, filenameLength, recordType, dataType, pos))
+            if dataType == b"blob":
+                pos += 4 + UInt32.unpack_from(buf, pos)[0]
+            elif dataType == b"ustr":
+                pos += 4 + UInt32.unpack_from(buf, pos)[0] * 2
+            else:
+                pos += FixedDataSizes[dataType]
+    except (struct.error, KeyError) as e:
+        raise DSStoreError("corrupt B-tree node: %s" % e)
+    return p, entries
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Free space and fragmentation in a DS_Store file's buddy allocator, and a
+# compaction tool for files that have bloated from repeated edits.
+#
+#   python freespace.py FILE...            one JSON report per file
+#   python freespace.py --compact FILE...  rewrite each file packed tight
+
+import errno
+import heapq
+import json
+import os
+import shutil
+import sys
+
+from buddy import BuddyAllocator, buildInfoBlock
+from dsstore import DSStoreError, offsetFromAddress, roundUpToNearest256, sizeFromAddress
+from fastparse import nodeLength
+from reader import ARENA_OFFSET, BTreeMetadataStruct, DSStoreReader, FileHeaderStruct
+
+def freeRanges(freeLists):
+    # Merges the free lists (each sorted, one per power of two) into sorted
+    # (start, end) ranges, joining ranges that touch, in a single pass
+    lists = [[(offset, offset + (1 << width)) for offset in sorted(freeList)]
+            for width, freeList in enumerate(freeLists)]
+    ranges = []
+    for start, end in heapq.merge(*lists):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def allocatedRanges(blockAddresses):
+    # (start, end, block number) for every allocated block, in file order,
+    # starting with the 32-byte BuddyAllocatorHeader at offset 0
+    ranges = [(0, 32, None)]
+    for blockNumber, address in enumerate(blockAddresses):
+        if address:
+            start = offsetFromAddress(address)
+            ranges.append((start, start + sizeFromAddress(address), blockNumber))
+    ranges.sort()
+    return ranges
+
+def _infoBlockLength(ds_store):
+    return (8 + 4 * roundUpToNearest256(ds_store.NumBlocks) + 4 +
+            sum(1 + len(name) + 4 for name in ds_store.Directory) +
+            sum(4 + 4 * freeList.Count for freeList in ds_store.FreeList))
+
+def _usedLength(ds_store, blockNumber, infoOffset, metadataBlocks):
+    # How much of a block its contents actually use
+    start, size = ds_store.block(blockNumber)
+    if start - ARENA_OFFSET == infoOffset:
+        return _infoBlockLength(ds_store)
+    if blockNumber in metadataBlocks:
+        return BTreeMetadataStruct.size
+    return nodeLength(ds_store._buf, start)
+
+def _packedLayout(ds_store):
+    # Allocates every block afresh, largest first, keeping block numbers.
+    # Handing out blocks in decreasing size leaves no holes bigger than the
+    # smallest block, so this is as tight as the buddy scheme allows.
+    allocator = BuddyAllocator()
+    blocks = [(sizeFromAddress(address), blockNumber)
+            for blockNumber, address in enumerate(ds_store.BlockAddresses[:ds_store.NumBlocks]) if address]
+    blocks.sort(key=lambda block: (-block[0], block[1]))
+    for size, blockNumber in blocks:
+        allocator.allocate(size, blockNumber)
+    return allocator
+
+def analyze(ds_store):
+    # Returns a report, as a dictionary, on a DSStoreReader's allocator
+    arenaEnd = len(ds_store._buf) - ARENA_OFFSET
+    infoOffset = ds_store.BuddyAllocatorHeader.InfoBlockOffset
+    metadataBlocks = set(ds_store.Directory.values())
+
+    allocatedHistogram = {}
+    allocatedBytes = usedBytes = 0
+    blocks = allocatedRanges(ds_store.BlockAddresses[:ds_store.NumBlocks])
+    for start, end, blockNumber in blocks:
+        size = end - start
+        allocatedHistogram[size] = allocatedHistogram.get(size, 0) + 1
+        allocatedBytes += size
+        usedBytes += size if blockNumber is None else _usedLength(ds_store, blockNumber, infoOffset, metadataBlocks)
+
+    # Only the free space below the end of the file costs anything
+    freeHistogram = {}
+    for width, freeList in enumerate(ds_store.FreeList):
+        inside = sum(1 for offset in freeList.Offset if offset < arenaEnd)
+        if inside:
+            freeHistogram[1 << width] = inside
+    free = [(start, min(end, arenaEnd)) for start, end in freeRanges(
+            [freeList.Offset for freeList in ds_store.FreeList]) if start < arenaEnd]
+    freeBytes = sum(end - start for start, end in free)
+    largestFree = max([end - start for start, end in free] or [0])
+
+    return {
+            "fileSize": len(ds_store._buf),
+            "blocks": len(blocks),
+            "allocatedBytes": allocatedBytes,
+            "usedBytes": usedBytes,
+            "wastedByRounding": allocatedBytes - usedBytes,
+            "freeBytes": freeBytes,
+            "freeRanges": len(free),
+            "largestFree": largestFree,
+            # 0 when all free space is one range, approaching 1 as it scatters
+            "fragmentation": 1 - float(largestFree) / freeBytes if freeBytes else 0.0,
+            "allocatedHistogram": allocatedHistogram,
+            "freeHistogram": freeHistogram,
+            "compactedSize": ARENA_OFFSET + _packedLayout(ds_store).end(),
+            }
+
+def compact(path, outPath=None):
+    # Rewrites path (or writes outPath) with every block moved down into a
+    # tightly packed layout.  Block contents are copied as they are, so the
+    # B-tree itself is not touched.  Returns (old size, new size).
+    with DSStoreReader(path) as ds_store:
+        header = ds_store.BuddyAllocatorHeader
+        allocator = _packedLayout(ds_store)
+        infoBlock = None
+        for blockNumber, address in enumerate(ds_store.BlockAddresses[:ds_store.NumBlocks]):
+            if address and offsetFromAddress(address) == header.InfoBlockOffset:
+                infoBlock = blockNumber
+        if infoBlock is None:
+            raise DSStoreError("the info block is missing from the block address table")
+
+        # The free lists, and so the info block, are smaller now; the info
+        # block keeps its old size class, which it is known to fit
+        infoData = buildInfoBlock(allocator, ds_store.Directory, ds_store.Zeros)
+        if len(infoData) > sizeFromAddress(allocator.BlockAddresses[infoBlock]):
+            raise DSStoreError("compacted info block does not fit")
+
+        out = bytearray(ARENA_OFFSET + allocator.end())
+        for blockNumber, address in enumerate(allocator.BlockAddresses):
+            if not address or blockNumber == infoBlock:
+                continue
+            start = ARENA_OFFSET + offsetFromAddress(address)
+            out[start:start + sizeFromAddress(address)] = ds_store.blockData(blockNumber)
+        infoAddress = allocator.BlockAddresses[infoBlock]
+        infoStart = ARENA_OFFSET + offsetFromAddress(infoAddress)
+        out[infoStart:infoStart + len(infoData)] = infoData
+        out[0:FileHeaderStruct.size] = FileHeaderStruct.pack(ds_store.FixedHeader, header.Magic,
+                offsetFromAddress(infoAddress), sizeFromAddress(infoAddress),
+                offsetFromAddress(infoAddress), header.Unknown)
+        oldSize = len(ds_store._buf)
+
+    # Write a sibling file and rename it over the original, so that a
+    # failure part way leaves the original alone.  The new file takes the
+    # original's mode and owner, or a compaction run as root would leave
+    # files their owners can no longer write.
+    target = outPath or path
+    temporary = target + ".compact"
+    with open(temporary, "wb") as f:
+        f.write(bytes(out))
+    try:
+        shutil.copystat(path, temporary)
+        st = os.stat(path)
+        try:
+            os.chown(temporary, st.st_uid, st.st_gid)
+        except OSError as e:
+            # Only root can give a file away; anyone else keeps it
+            if e.errno != errno.EPERM:
+                raise
+        os.rename(temporary, target)
+    except EnvironmentError:
+        os.remove(temporary)
+        raise
+    return oldSize, len(out)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    compacting = "--compact" in args
+    for path in [a for a in args if a != "--compact"]:
+        try:
+            if compacting:
+                oldSize, newSize = compact(path)
+                result = {"path": path, "oldSize": oldSize, "newSize": newSize}
+            else:
+                with DSStoreReader(path) as ds_store:
+                    result = analyze(ds_store)
+                result["path"] = path
+        except (DSStoreError, EnvironmentError) as e:
+            result = {"path": path, "error": str(e)}
+        print json.dumps(result, sort_keys=True)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Opt-in counters and timings for the parsing pipeline.
+#
+#   stats = instrument.enable()
+#   ... open readers, walk records, decode plists and aliases ...
+#   instrument.disable()
+#   print stats.asDict()
+#
+# While enabled, DSStoreReader counts every node it decodes and the records
+# in it (by RecordType and DataType), the bytes it reads, and the time spent
+# on the header and B-tree metadata, the block address table and free lists,
+# and node decoding.  LazyPlist and AliasView count and time their decodes as
+# the payload stage.  Each of those spots checks the module-level collector
+# once per node or payload, so leaving this disabled costs next to nothing.
+#
+# The collector is per process; each scanner worker keeps its own.
+
+import timeit
+
+HEADER = "header"
+BLOCK_TABLE = "blockTable"
+NODE = "node"
+PAYLOAD = "payload"
+STAGES = (HEADER, BLOCK_TABLE, NODE, PAYLOAD)
+
+timer = timeit.default_timer
+
+# The ParseStats being filled in, or None when instrumentation is off
+collector = None
+
+class ParseStats(object):
+    # callback, if given, is called as callback(stage, seconds, bytes) after
+    # every timed step, e.g. to feed a metrics client
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.nodes = 0
+        self.bytesRead = 0
+        self.recordTypes = {}
+        self.dataTypes = {}
+        self.plistDecodes = 0
+        self.aliasDecodes = 0
+        self.times = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, elapsed, nbytes=0):
+        self.times[stage] += elapsed
+        self.bytesRead += nbytes
+        if self.callback is not None:
+            self.callback(stage, elapsed, nbytes)
+
+    def addNode(self, records, elapsed, nbytes):
+        self.nodes += 1
+        recordTypes = self.recordTypes
+        dataTypes = self.dataTypes
+        for r in records:
+            recordTypes[r.RecordType] = recordTypes.get(r.RecordType, 0) + 1
+            dataTypes[r.DataType] = dataTypes.get(r.DataType, 0) + 1
+        self.add(NODE, elapsed, nbytes)
+
+    def merge(self, other):
+        # Folds in the counts of another ParseStats, or of its asDict()
+        if isinstance(other, ParseStats):
+            other = other.asDict()
+        for name in ("nodes", "bytesRead", "plistDecodes", "aliasDecodes"):
+            setattr(self, name, getattr(self, name) + other[name])
+        for name in ("recordTypes", "dataTypes", "times"):
+            counts = getattr(self, name)
+            for key, value in other[name].items():
+                counts[key] = counts.get(key, 0) + value
+
+    def records(self):
+        return sum(self.recordTypes.values())
+
+    def asDict(self):
+        return {
+                "nodes": self.nodes,
+                "records": self.records(),
+                "bytesRead": self.bytesRead,
+                "recordTypes": dict(self.recordTypes),
+                "dataTypes": dict(self.dataTypes),
+                "plistDecodes": self.plistDecodes,
+                "aliasDecodes": self.aliasDecodes,
+                "times": dict(self.times),
+                }
+
+def enable(stats=None, callback=None):
+    # Starts collecting into stats (a new ParseStats by default) and
+    # returns it
+    global collector
+    collector = stats if stats is not None else ParseStats(callback)
+    return collector
+
+def disable():
+    # Stops collecting and returns what was collected
+    global collector
+    stats, collector = collector, None
+    return stats
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# A DS_Store reader that maps the file into memory and only decodes what it is
+# asked for.  DSStoreFile.parse() follows every Pointer down to the root
+# BTreeNode as soon as it is called; here we decode the BuddyAllocatorHeader
+# and the BuddyAllocatorMetadata block address table up front, and leave the
+# B-tree nodes alone until somebody touches them.
+
+import mmap
+import struct
+from bisect import bisect_left
+
+from construct import Container
+
+import instrument
+from dsstore import BTreeNode, DSStoreError, LazyPlist, offsetFromAddress, recordKey, roundUpToNearest256, sizeFromAddress
+from fastparse import parseBTreeNode
+
+# The 4-byte fudge factor: every offset stored in the file is relative to the
+# end of the leading FixedHeader.
+ARENA_OFFSET = 4
+
+# FixedHeader followed by the BuddyAllocatorHeader
+FileHeaderStruct = struct.Struct(">I4sIII16s")
+UInt32 = struct.Struct(">I")
+BTreeMetadataStruct = struct.Struct(">IIIII")
+
+def nodeEntries(node):
+    # Splits a BTreeNode into its records and, for internal nodes, its
+    # children.  Child i holds the keys that sort before record i; the node's
+    # P pointer is the last child, holding everything after the last record.
+    if node.P == 0:
+        return node.BlockData, None
+    records = [entry.Record for entry in node.BlockData]
+    children = [entry.ChildBlockNumber for entry in node.BlockData]
+    children.append(node.P)
+    return records, children
+
+def parseHeader(buf, fileSize):
+    # Unpacks the FixedHeader and BuddyAllocatorHeader at the start of buf
+    # and returns them as (FixedHeader, BuddyAllocatorHeader), having
+    # checked the magic, the backup offset and that the info block lies
+    # inside a file of fileSize bytes.  Shared with validate.py, which only
+    # reads this much of the file.
+    if len(buf) < FileHeaderStruct.size:
+        raise DSStoreError("file too short for a buddy allocator header")
+    fixed, magic, offset, size, backup, unknown = FileHeaderStruct.unpack_from(buf, 0)
+    if magic != b"Bud1":
+        raise DSStoreError("bad magic %r" % magic)
+    if offset != backup:
+        raise DSStoreError("InfoBlockOffset %#x does not match its backup %#x" % (offset, backup))
+    if ARENA_OFFSET + offset + size > fileSize:
+        raise DSStoreError("info block (%#x bytes at %#x) runs past the end of the file" % (size, offset))
+    return fixed, Container(
+            Magic = magic,
+            InfoBlockOffset = offset,
+            InfoBlockSize = size,
+            InfoBlockOffsetBackup = backup,
+            Unknown = unknown,
+            )
+
+def parseInfoBlock(buf, pos, end):
+    # Unpacks the info block held in buf[pos:end] and returns (NumBlocks,
+    # Zeros, BlockAddresses, Directory, FreeList).  The counts in it are
+    # checked against end before anything is unpacked, so that a corrupt
+    # one can't ask for a table of gigabytes.
+    try:
+        numBlocks, zeros = struct.unpack_from(">II", buf, pos)
+        pos += 8
+        # The table is padded with zeroes to a multiple of 256 entries
+        tableLength = roundUpToNearest256(numBlocks)
+        if pos + 4 * tableLength > end:
+            raise DSStoreError("block address table (%d entries) runs past the end of the info block" % numBlocks)
+        addresses = list(struct.unpack_from(">%dI" % tableLength, buf, pos))
+        pos += 4 * tableLength
+
+        directoryCount, = UInt32.unpack_from(buf, pos)
+        pos += 4
+        # Each entry takes at least a length byte and a block number
+        if pos + 5 * directoryCount > end:
+            raise DSStoreError("allocator directory (%d entries) runs past the end of the info block" % directoryCount)
+        directory = {}
+        for i in range(directoryCount):
+            length = ord(buf[pos:pos + 1])
+            if pos + 1 + length + 4 > end:
+                raise DSStoreError("allocator directory runs past the end of the info block")
+            name = buf[pos + 1:pos + 1 + length]
+            directory[name], = UInt32.unpack_from(buf, pos + 1 + length)
+            pos += 1 + length + 4
+
+        freeList = []
+        for i in range(32):
+            if pos + 4 > end:
+                raise DSStoreError("free list %d runs past the end of the info block" % i)
+            count, = UInt32.unpack_from(buf, pos)
+            if pos + 4 + 4 * count > end:
+                raise DSStoreError("free list %d (%d entries) runs past the end of the info block" % (i, count))
+            offsets = list(struct.unpack_from(">%dI" % count, buf, pos + 4))
+            freeList.append(Container(Count = count, Offset = offsets))
+            pos += 4 + 4 * count
+    except (struct.error, TypeError):
+        # TypeError is ord() of an empty slice past the end
+        raise DSStoreError("info block is truncated")
+    return numBlocks, zeros, addresses, directory, freeList
+
+class DSStoreReader(object):
+    # With decodePlists=False the bwsp/icvp/lsvp/lsvP records come back as
+    # plain blobData containers, and biplist is never called.  fast=False
+    # decodes nodes with the construct schema instead of fastparse.
+    def __init__(self, path, decodePlists=True, fast=True):
+        with open(path, "rb") as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # mmap refuses zero-length files
+                raise DSStoreError("%s: empty file" % path)
+        self._init(buf, buf, decodePlists, fast)
+
+    @classmethod
+    def fromBuffer(cls, buf, decodePlists=True, fast=True):
+        self = cls.__new__(cls)
+        self._init(buf, None, decodePlists, fast)
+        return self
+
+    def _init(self, buf, mapping, decodePlists, fast):
+        self._buf = buf
+        self._map = mapping
+        self.decodePlists = decodePlists
+        self.fast = fast
+        self._nodes = {}
+        self._leaf = None
+        stats = instrument.collector
+        if stats is None:
+            self._readHeader()
+            self._readInfoBlock()
+            self._readBTreeMetadata()
+            return
+        start = instrument.timer()
+        self._readHeader()
+        stats.add(instrument.HEADER, instrument.timer() - start, FileHeaderStruct.size)
+        start = instrument.timer()
+        self._readInfoBlock()
+        stats.add(instrument.BLOCK_TABLE, instrument.timer() - start, self.BuddyAllocatorHeader.InfoBlockSize)
+        start = instrument.timer()
+        self._readBTreeMetadata()
+        stats.add(instrument.HEADER, instrument.timer() - start, BTreeMetadataStruct.size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._buf = None
+        self._nodes = {}
+        self._leaf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _readHeader(self):
+        self.FixedHeader, self.BuddyAllocatorHeader = parseHeader(self._buf, len(self._buf))
+
+    def _readInfoBlock(self):
+        start = ARENA_OFFSET + self.BuddyAllocatorHeader.InfoBlockOffset
+        (self.NumBlocks, self.Zeros, self.BlockAddresses, self.Directory,
+                self.FreeList) = parseInfoBlock(self._buf, start, start + self.BuddyAllocatorHeader.InfoBlockSize)
+
+    def _readBTreeMetadata(self):
+        if b"DSDB" not in self.Directory:
+            raise DSStoreError("no DSDB entry in the allocator directory")
+        start, size = self.block(self.Directory[b"DSDB"])
+        (root, levels, records, nodes,
+                pageSize) = BTreeMetadataStruct.unpack_from(self._buf, start)
+        # Each level takes a block at least, and get() loops over the levels
+        if levels >= self.NumBlocks:
+            raise DSStoreError("NumLevels (%d) is more than there are blocks (%d)" % (levels, self.NumBlocks))
+        self.BTreeMetadata = Container(
+                RootBlockNumber = root,
+                NumLevels = levels,
+                NumRecords = records,
+                NumNodes = nodes,
+                PageSize = pageSize,
+                )
+
+    def block(self, blockNumber):
+        # Returns the (file offset, size) of a block, checked against the
+        # file so that a bad address fails here rather than deep in a parse.
+        if not 0 <= blockNumber < len(self.BlockAddresses):
+            raise DSStoreError("block %d is not in the block address table" % blockNumber)
+        address = self.BlockAddresses[blockNumber]
+        if address == 0:
+            raise DSStoreError("block %d is not allocated" % blockNumber)
+        start = ARENA_OFFSET + offsetFromAddress(address)
+        size = sizeFromAddress(address)
+        if start + size > len(self._buf):
+            raise DSStoreError("block %d (%#x bytes at %#x) runs past the end of the file" % (blockNumber, size, start))
+        return start, size
+
+    def blockData(self, blockNumber):
+        start, size = self.block(blockNumber)
+        return self._buf[start:start + size]
+
+    def _decodeNode(self, blockNumber):
+        stats = instrument.collector
+        if stats is None:
+            return self._parseNode(blockNumber)
+        start = instrument.timer()
+        node = self._parseNode(blockNumber)
+        stats.addNode(nodeEntries(node)[0], instrument.timer() - start, self.block(blockNumber)[1])
+        return node
+
+    def _parseNode(self, blockNumber):
+        if self.fast:
+            start, size = self.block(blockNumber)
+            return parseBTreeNode(self._buf, start, start + size)
+        return BTreeNode.parse(self.blockData(blockNumber))
+
+    def _entry(self, blockNumber):
+        # Internal nodes are few and sit on every path from the root, so they
+        # are kept once decoded.  Leaves hold nearly all of the records; only
+        # the most recently used one is kept, so that memory stays bounded by
+        # the depth of the tree rather than the number of records.
+        entry = self._nodes.get(blockNumber)
+        if entry is None:
+            if self._leaf is not None and self._leaf[0] == blockNumber:
+                return self._leaf[1]
+            node = self._decodeNode(blockNumber)
+            records, children = nodeEntries(node)
+            if not self.decodePlists:
+                for r in records:
+                    if isinstance(r.RecordData, LazyPlist):
+                        blob = r.RecordData.Blob
+                        r.RecordData = Container(Length = len(blob), Blob = blob)
+            keys = [recordKey(r.Filename, r.RecordType) for r in records]
+            entry = (node, records, children, keys)
+            if children is None:
+                self._leaf = (blockNumber, entry)
+            else:
+                self._nodes[blockNumber] = entry
+        return entry
+
+    def node(self, blockNumber):
+        return self._entry(blockNumber)[0]
+
+    def rootNode(self):
+        return self.node(self.BTreeMetadata.RootBlockNumber)
+
+    def get(self, filename, recordType, default=None):
+        # Descends from the root, binary-searching each node for the key and
+        # following the child that would contain it.
+        key = recordKey(filename, recordType)
+        blockNumber = self.BTreeMetadata.RootBlockNumber
+        for level in range(self.BTreeMetadata.NumLevels + 1):
+            node, records, children, keys = self._entry(blockNumber)
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return records[i]
+            if children is None:
+                return default
+            blockNumber = children[i]
+        raise DSStoreError("B-tree is deeper than NumLevels (%d)" % self.BTreeMetadata.NumLevels)
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def records(self, start=None):
+        # Yields every record in key order, or with start (a recordKey) every
+        # record from the first whose key is not less than it.  The walk keeps
+        # one (records, children, index) frame per level of the tree, where
+        # index is the record to emit once the child before it has been
+        # finished; seeking just starts each level at the bisected index.
+        stack = []
+        blockNumber = self.BTreeMetadata.RootBlockNumber
+        while True:
+            if len(stack) > self.BTreeMetadata.NumLevels:
+                raise DSStoreError("B-tree is deeper than NumLevels (%d)" % self.BTreeMetadata.NumLevels)
+            node, records, children, keys = self._entry(blockNumber)
+            i = 0 if start is None else bisect_left(keys, start)
+            if children is not None:
+                stack.append((records, children, i))
+                blockNumber = children[i]
+                continue
+            for record in records[i:] if i else records:
+                yield record
+            while stack:
+                records, children, i = stack.pop()
+                if i < len(records):
+                    yield records[i]
+                    stack.append((records, children, i + 1))
+                    blockNumber = children[i + 1]
+                    break
+            else:
+                return
+
+    __iter__ = records
+
+    def range(self, start=None, stop=None):
+        # Records with start <= key < stop, as recordKeys; either end can be
+        # left open
+        for record in self.records(start):
+            if stop is not None and recordKey(record.Filename, record.RecordType) >= stop:
+                return
+            yield record
+
+    def query(self, prefix=None, filename=None, recordTypes=None):
+        # Records whose filename starts with prefix, or is filename, and
+        # whose RecordType is in recordTypes.  Filenames compare without
+        # regard to case, as they do in the tree.  Given a prefix or a
+        # filename, the walk seeks straight to the first match and stops
+        # after the last, so the work done is proportional to the number of
+        # records in that range; a query on recordTypes alone has to look
+        # at every record.
+        if filename is not None:
+            lower = filename.lower()
+            matches = lambda name: name == lower
+        elif prefix is not None:
+            lower = prefix.lower()
+            matches = lambda name: name.startswith(lower)
+        else:
+            lower = None
+        if recordTypes is not None and not isinstance(recordTypes, (set, frozenset)):
+            recordTypes = frozenset(recordTypes)
+        for record in self.records(None if lower is None else (lower, b"")):
+            if lower is not None and not matches(record.Filename.lower()):
+                return
+            if recordTypes is None or record.RecordType in recordTypes:
+                yield record
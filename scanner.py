@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Walks a directory tree, parses every .DS_Store it finds in a pool of worker
+# processes, and writes one JSON object per file to a JSONL stream as results
+# come in.  A file that fails to parse produces an "error" line instead of
+# stopping the run.
+#
+#   python scanner.py /Volumes/share -j 16 --types Iloc,bwsp -o out.jsonl
+#
+# With --stats every line also carries the parse counters and timings from
+# instrument.py, and the totals are written to stderr at the end.
+
+import argparse
+import base64
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+
+import instrument
+from dsstore import LazyPlist
+from reader import DSStoreReader
+
+DS_STORE_NAME = ".DS_Store"
+
+def findDSStores(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        if DS_STORE_NAME in filenames:
+            yield os.path.join(dirpath, DS_STORE_NAME)
+
+def _jsonable(value):
+    # Plist payloads hold dictionaries, arrays, numbers, dates, text and raw
+    # data; blobs are raw bytes.  Raw bytes go out as base64.
+    if isinstance(value, dict):
+        return dict((_text(k), _jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return _text(value)
+    return value
+
+def _text(value):
+    if isinstance(value, bytes):
+        try:
+            return value.decode("ascii")
+        except UnicodeDecodeError:
+            return {"base64": base64.b64encode(value).decode("ascii")}
+    return value
+
+def recordValue(record):
+    data = record.RecordData
+    dataType = record.DataType
+    if dataType == "BLOB":
+        if isinstance(data, LazyPlist):
+            return _jsonable(data.value)
+        return {"base64": base64.b64encode(data.Blob).decode("ascii")}
+    if dataType == "USTR":
+        return data.Data
+    if dataType == "TYPE":
+        return _text(data.RecordType)
+    if dataType == "DUTC":
+        return data.Ticks
+    return data.Value
+
+def recordToJSON(record):
+    return {
+            "filename": record.Filename,
+            "type": _text(record.RecordType),
+            "value": recordValue(record),
+            }
+
+def _pathFields(path):
+    # Paths are bytes, in whatever encoding the volume uses.  One that isn't
+    # UTF-8 goes out with replacement characters, and in full as base64.
+    if not isinstance(path, bytes):
+        return {"path": path}
+    try:
+        return {"path": path.decode("utf_8")}
+    except UnicodeDecodeError:
+        return {"path": path.decode("utf_8", "replace"),
+                "pathBase64": base64.b64encode(path).decode("ascii")}
+
+def scanFile(job):
+    # Runs in a worker.  job is (path, record types to emit or None for a
+    # per-type summary, whether to collect ParseStats).  Returns (JSON line,
+    # whether the file failed, the stats as a dict or None).  The line is
+    # made here, so that a file whose result can't be serialized fails on
+    # its own rather than taking the whole scan with it.
+    path, recordTypes, collectStats = job
+    stats = None
+    if collectStats:
+        instrument.enable()
+    try:
+        result = _scanFile(path, recordTypes)
+    finally:
+        if collectStats:
+            stats = instrument.disable().asDict()
+            result["stats"] = stats
+    try:
+        return json.dumps(result, sort_keys=True), "error" in result, stats
+    except (TypeError, ValueError, UnicodeError) as e:
+        result = _pathFields(path)
+        result["error"] = "cannot serialize result: %s: %r" % (type(e).__name__, e)
+        if stats is not None:
+            result["stats"] = stats
+        return json.dumps(result, sort_keys=True), True, stats
+
+def _scanFile(path, recordTypes):
+    result = _pathFields(path)
+    try:
+        with DSStoreReader(path, decodePlists=recordTypes is not None) as ds_store:
+            m = ds_store.BTreeMetadata
+            result.update({
+                    "size": os.path.getsize(path),
+                    "records": m.NumRecords,
+                    "levels": m.NumLevels,
+                    "nodes": m.NumNodes,
+                    })
+            if recordTypes is None:
+                counts = {}
+                for record in ds_store.records():
+                    recordType = _text(record.RecordType)
+                    counts[recordType] = counts.get(recordType, 0) + 1
+                result["types"] = counts
+            else:
+                result["entries"] = [recordToJSON(record)
+                        for record in ds_store.records()
+                        if record.RecordType in recordTypes]
+            return result
+    except Exception as e:
+        result = _pathFields(path)
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        return result
+
+def scan(root, out, workers=None, chunkSize=64, recordTypes=None, stats=None):
+    # Returns (files scanned, files that failed).  If stats is a
+    # ParseStats, every file's counters are collected and added to it.
+    jobs = ((path, recordTypes, stats is not None) for path in findDSStores(root))
+    scanned = failed = 0
+    if workers == 1:
+        results = (scanFile(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(scanFile, jobs, chunkSize)
+    try:
+        for line, error, fileStats in results:
+            scanned += 1
+            if error:
+                failed += 1
+            if stats is not None:
+                stats.merge(fileStats)
+            out.write(line + "\n")
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return scanned, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan a directory tree for .DS_Store files.")
+    parser.add_argument("root")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+            help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=64,
+            help="files handed to a worker at a time")
+    parser.add_argument("--types", default=None,
+            help="comma-separated record types to emit, e.g. Iloc,bwsp; without it each file gets a per-type summary")
+    parser.add_argument("-o", "--output", default=None, help="JSONL output file (default: stdout)")
+    parser.add_argument("--stats", action="store_true", help="collect parse counters and timings")
+    args = parser.parse_args()
+
+    recordTypes = None
+    if args.types:
+        recordTypes = frozenset(args.types.split(","))
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        stats = instrument.ParseStats() if args.stats else None
+        scanned, failed = scan(args.root, out, args.workers, args.chunk_size, recordTypes, stats)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("%d files scanned, %d failed\n" % (scanned, failed))
+    if stats is not None:
+        sys.stderr.write(json.dumps(stats.asDict(), sort_keys=True) + "\n")
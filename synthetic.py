@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Generates valid synthetic .DS_Store files for benchmarks and fixtures.
+#
+#   python synthetic.py OUT COUNT [--mix Iloc=8,cmmt=1] [--filename-length 8:24]
+#                                 [--depth N] [--seed N]
+#
+# The record-type mix is a set of weights; every record type gets a value of
+# the shape Finder stores for it, so the files go through both the construct
+# schema and the fast path.  Trees are packed into 4096-byte pages, as Finder
+# writes them.  A minimum depth is reached by capping the records in a node,
+# at the most that still gives a tree that deep.
+
+import argparse
+import random
+import struct
+
+import biplist
+
+from alias import FILENAME_UTF16, VOLUMENAME_UTF16, aliasString, buildAlias
+from builder import bulkLoad
+from reader import DSStoreReader
+
+DEFAULT_MIX = {
+        b"Iloc": 10,
+        b"cmmt": 1,
+        b"logS": 1,
+        b"lg1S": 1,
+        b"phyS": 1,
+        b"modD": 1,
+        b"dscl": 1,
+        b"bwsp": 1,
+        b"lsvp": 1,
+        b"icvp": 1,
+        b"fwi0": 1,
+        b"icgo": 1,
+        b"lssp": 1,
+        b"vstl": 1,
+        }
+
+def aliasBlob(filename, volume=u"Macintosh HD", rnd=random):
+    # A minimal version 2 alias record with FILENAME_UTF16, VOLUMENAME_UTF16
+    # and VOLUME_RELATIVE_PATH tags
+    header = {
+            "UserType": 0, "RecordVersion": 2, "AliasKind": 0,
+            "VolumeName": volume.encode("utf_8"), "VolumeMacDate": rnd.randint(0, 2 ** 31),
+            "VolumeSignature": 0x482b, "VolumeType": 0, "ParentDirID": rnd.randint(2, 2 ** 20),
+            "FileName": filename.encode("utf_8"), "FileNumber": rnd.randint(16, 2 ** 24),
+            "FileMacDate": rnd.randint(0, 2 ** 31), "FileType": b"PNGf", "FileCreator": b"8BIM",
+            "nlvlFrom": 1, "nlvlTo": 1, "VolumeFlags": 0, "VolumeFSID": 0, "Reserved": b"\0" * 10,
+            }
+    return buildAlias(header, [
+            (FILENAME_UTF16, aliasString(filename)),
+            (VOLUMENAME_UTF16, aliasString(volume)),
+            (18, filename.encode("utf_8")),
+            ])
+
+def _plist(recordType, rnd):
+    if recordType == b"bwsp":
+        return {
+                "WindowBounds": "{{%d, %d}, {%d, %d}}" % (rnd.randint(0, 800), rnd.randint(0, 600),
+                        rnd.randint(400, 1600), rnd.randint(300, 1000)),
+                "SidebarWidth": rnd.randint(0, 300),
+                "ShowSidebar": True,
+                "ShowToolbar": True,
+                "ShowStatusBar": False,
+                "ShowPathbar": False,
+                }
+    if recordType == b"icvp":
+        value = {
+                "arrangeBy": "none",
+                "iconSize": float(rnd.choice([32, 48, 64, 128])),
+                "gridSpacing": 54.0,
+                "textSize": 12.0,
+                "labelOnBottom": True,
+                "showIconPreview": True,
+                "showItemInfo": False,
+                "viewOptionsVersion": 1,
+                "backgroundType": 2,
+                }
+        value["backgroundImageAlias"] = biplist.Data(aliasBlob(u"background.png", rnd=rnd))
+        return value
+    return {
+            "iconSize": 16.0,
+            "textSize": 12.0,
+            "sortColumn": "name",
+            "useRelativeDates": True,
+            "calculateAllSizes": False,
+            "viewOptionsVersion": 1,
+            "columns": [{"ascending": True, "identifier": "name", "visible": True, "width": 300}],
+            }
+
+def recordValue(recordType, rnd):
+    if recordType == b"Iloc":
+        return struct.pack(">II", rnd.randint(0, 2000), rnd.randint(0, 2000)) + b"\xff" * 6 + b"\0\0"
+    if recordType == b"fwi0":
+        return struct.pack(">HHHH4sHH", 40, 40, 600, 900, b"icnv", 0, 0)
+    if recordType in (b"icgo", b"icsp", b"lssp"):
+        return b"\0" * 7 + b"\x04"
+    if recordType == b"dilc":
+        return b"\0" * 32
+    if recordType in (b"bwsp", b"icvp", b"lsvp", b"lsvP"):
+        return _plist(recordType, rnd)
+    if recordType in (b"cmmt", b"extn", b"GRP0"):
+        return u"comment %d" % rnd.randint(0, 10 ** 6)
+    if recordType in (b"logS", b"lg1S", b"phyS", b"ph1S"):
+        return rnd.randint(0, 2 ** 40)
+    if recordType in (b"modD", b"moDD"):
+        return rnd.randint(0, 2 ** 62)
+    if recordType == b"vstl":
+        return b"icnv"
+    # bool and long/shor record types
+    return 1
+
+def records(count, mix=None, filenameLength=(8, 24), seed=0):
+    # Yields (filename, recordType, value) tuples with distinct keys
+    rnd = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    types = sorted(mix)
+    cumulative = []
+    total = 0
+    for recordType in types:
+        total += mix[recordType]
+        cumulative.append(total)
+    perFile = max(1, int(round(float(total) / max(mix.values()))))
+    alphabet = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_- "
+    seen = set()
+    fileIndex = 0
+    filename = None
+    produced = 0
+    while produced < count:
+        if filename is None or rnd.randrange(perFile) == 0:
+            length = rnd.randint(*filenameLength)
+            stem = u"%06d" % fileIndex
+            filename = stem + u"".join(rnd.choice(alphabet) for i in range(max(0, length - len(stem))))
+            fileIndex += 1
+        pick = rnd.random() * total
+        recordType = next(t for t, c in zip(types, cumulative) if pick < c)
+        if (filename, recordType) in seen:
+            filename = None
+            continue
+        seen.add((filename, recordType))
+        produced += 1
+        yield filename, recordType, recordValue(recordType, rnd)
+
+def generate(count, mix=None, filenameLength=(8, 24), depth=None, seed=0):
+    # Returns the contents of a synthetic file with count records, in a
+    # tree of at least depth levels counting the leaves.  Raises ValueError
+    # if count records can't make a tree that deep.
+    items = list(records(count, mix, filenameLength, seed))
+    data = bulkLoad(items)
+    if depth is None or _depth(data) >= depth:
+        return data
+    # The fewer records a node, the deeper the tree: find the most that
+    # still reach depth
+    data = bulkLoad(items, maxRecords=1)
+    if _depth(data) < depth:
+        raise ValueError("%d records make a tree of at most %d levels, not %d" % (count, _depth(data), depth))
+    low, high = 1, max(1, count)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if _depth(bulkLoad(items, maxRecords=middle)) >= depth:
+            low = middle
+        else:
+            high = middle - 1
+    return bulkLoad(items, maxRecords=low)
+
+def _depth(data):
+    return DSStoreReader.fromBuffer(data).BTreeMetadata.NumLevels + 1
+
+def parseMix(text):
+    mix = {}
+    for item in text.split(","):
+        recordType, weight = item.split("=")
+        mix[recordType.encode("ascii")] = float(weight)
+    return mix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic .DS_Store file.")
+    parser.add_argument("output")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--mix", type=parseMix, default=None,
+            help="record type weights, e.g. Iloc=8,bwsp=1")
+    parser.add_argument("--filename-length", default="8:24", help="MIN:MAX characters")
+    parser.add_argument("--depth", type=int, default=None, help="minimum tree depth")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    low, high = [int(x) for x in args.filename_length.split(":")]
+    with open(args.output, "wb") as f:
+        f.write(generate(args.count, args.mix, (low, high), args.depth, args.seed))
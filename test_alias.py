@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# AliasView and buildAlias against the construct schema, edits written back
+# through AliasRecord.build, and backgroundAliases over a batch of files,
+# some of them corrupt.  Run with py.test.
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+import biplist
+
+from alias import (FILENAME_UTF16, VOLUMENAME_UTF16, AliasHeaderFields, AliasRecord, AliasType,
+        AliasView, aliasString, backgroundAliases, buildAlias)
+from builder import writeDSStore
+from synthetic import aliasBlob
+
+def test_corrupt_files_are_skipped():
+    directory = tempfile.mkdtemp()
+    try:
+        good = os.path.join(directory, "good")
+        writeDSStore(good, [
+                (u".", b"icvp", {"backgroundImageAlias": biplist.Data(aliasBlob(u"icvp.png"))}),
+                (u".", b"pict", aliasBlob(u"pict.png")),
+                ])
+        with open(good, "rb") as f:
+            data = f.read()
+        # A plist whose top object number, in its trailer, is out of range.
+        # The pict record still comes out before the plist is decoded.
+        start = data.index(b"bplist00")
+        end = start + struct.unpack(">I", data[start - 4:start])[0]
+        badPlist = os.path.join(directory, "badPlist")
+        with open(badPlist, "wb") as f:
+            f.write(data[:end - 16] + b"\xff" * 8 + data[end - 8:])
+        # An icvp plist that isn't a dictionary
+        notDict = os.path.join(directory, "notDict")
+        writeDSStore(notDict, [(u".", b"icvp", [1, 2])])
+        truncated = os.path.join(directory, "truncated")
+        with open(truncated, "wb") as f:
+            f.write(data[:100])
+
+        paths = [badPlist, notDict, truncated, os.path.join(directory, "missing"), good]
+        found = [(os.path.basename(path), recordType, view.FileName)
+                for path, recordType, view in backgroundAliases(paths)]
+        assert found == [("badPlist", b"pict", b"pict.png"),
+                ("good", b"pict", b"pict.png"), ("good", b"icvp", b"icvp.png")]
+    finally:
+        shutil.rmtree(directory)
+
+def sampleAliases():
+    rnd = random.Random(7)
+    yield aliasBlob(u"background.png", rnd=rnd)
+    yield aliasBlob(u"odd.png", volume=u"Disk", rnd=rnd)
+    yield aliasBlob(u"\u00e9t\u00e9 \U0001F600.tiff", volume=u"Volume \u00e9", rnd=rnd)
+
+def tagNumber(name):
+    return struct.unpack(">H", AliasType.build(name))[0]
+
+def test_view_matches_construct():
+    for blob in sampleAliases():
+        view = AliasView(blob)
+        record = AliasRecord.parse(blob)
+        for name in AliasHeaderFields:
+            expected = record[name]
+            if name in ("VolumeName", "FileName"):
+                # Bare bytes in the view
+                expected = expected.Name
+            elif name in ("AliasKind", "VolumeType"):
+                # Numbers in the view, names from the Enums
+                expected = {"FILE": 0, "DIRECTORY": 1, "FIXED_HD": 0}[expected]
+            assert getattr(view, name) == expected, name
+        items = [(tagNumber(item.AliasType), item.AliasData[:item.AliasLength])
+                for item in record.AliasBlob if item.AliasType != "END_OF_LIST"]
+        assert view.items() == items
+        for item in record.AliasBlob:
+            if "DataAsString" in item:
+                assert view.tagString(tagNumber(item.AliasType)) == item.DataAsString.Data
+
+def test_build_alias_round_trip():
+    header = dict(AliasView(aliasBlob(u"x.png")).header())
+    header["FileName"] = b"y.png"
+    tags = [(FILENAME_UTF16, aliasString(u"y.png")), (VOLUMENAME_UTF16, aliasString(u"Disk")),
+            (18, b"odd"), (2, b"/Volumes/Disk/y.png")]
+    blob = buildAlias(header, tags)
+    view = AliasView(blob)
+    assert view.AliasSize == len(blob)
+    assert view.FileName == b"y.png" and view.filename == u"y.png" and view.volumeName == u"Disk"
+    assert view.items() == tags
+    for name in AliasHeaderFields:
+        if name not in ("AliasSize", "FileName"):
+            assert getattr(view, name) == header[name], name
+    assert AliasRecord.build(AliasRecord.parse(blob)) == blob
+
+def test_edit_string_tag_to_another_length():
+    for blob in sampleAliases():
+        record = AliasRecord.parse(blob)
+        for item in record.AliasBlob:
+            if item.AliasType == "FILENAME_UTF16":
+                item.DataAsString.Data = u"longer-name-than-before.png"
+            elif item.AliasType == "VOLUMENAME_UTF16":
+                item.DataAsString.Data = u"V"
+        edited = AliasRecord.build(record)
+        view = AliasView(edited)
+        assert view.AliasSize == len(edited)
+        assert view.tagString(FILENAME_UTF16) == u"longer-name-than-before.png"
+        assert view.tagString(VOLUMENAME_UTF16) == u"V"
+        # Everything else is as it was
+        before = AliasView(blob)
+        assert [t for t in view.items() if t[0] not in (FILENAME_UTF16, VOLUMENAME_UTF16)] == \
+                [t for t in before.items() if t[0] not in (FILENAME_UTF16, VOLUMENAME_UTF16)]
+        assert AliasRecord.parse(edited).AliasData == record.AliasData
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Bulk-loaded files, including records too big to share a page, checked the
+# same way as the writer's (see test_writer.checkFile).  Run with py.test.
+
+import os
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from builder import bulkLoad, writeDSStore
+from reader import DSStoreReader
+from test_writer import checkFile
+from writer import DSStoreWriter, makeRecord
+
+@pytest.fixture
+def path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, "DS_Store")
+    shutil.rmtree(directory)
+
+def build(path, items):
+    # Writes items, (filename, recordType, value) tuples, and returns the
+    # model checkFile expects
+    records = [makeRecord(*item) for item in items]
+    writeDSStore(path, records)
+    return dict(((r.Filename, r.RecordType), r.RecordData) for r in records)
+
+def test_empty(path):
+    checkFile(path, build(path, []))
+
+def test_small_records(path):
+    model = build(path, [(u"f%04d" % i, b"cmmt", u"c" * 40) for i in range(3000)])
+    checkFile(path, model)
+    with DSStoreReader(path) as ds_store:
+        assert ds_store.BTreeMetadata.NumLevels >= 2
+        for blockNumber in range(2, ds_store.NumBlocks):
+            assert ds_store.block(blockNumber)[1] == 4096
+
+def test_duplicate_keys_last_wins(path):
+    # Keys compare without case, as Finder does
+    writeDSStore(path, [(u"a", b"cmmt", u"old"), (u"b", b"cmmt", u"b"), (u"A", b"cmmt", u"new")])
+    with DSStoreReader(path) as ds_store:
+        assert [(r.Filename, r.RecordData.Data) for r in ds_store.records()] == [(u"A", u"new"), (u"b", u"b")]
+
+def test_two_records_over_half_a_page(path):
+    model = build(path, [(u"f0", b"cmmt", u"x" * 1300), (u"f1", b"cmmt", u"x" * 1300)])
+    checkFile(path, model)
+    with DSStoreReader(path) as ds_store:
+        assert ds_store.BTreeMetadata.NumNodes == 1
+
+def test_record_over_a_page(path):
+    model = build(path, [(u".", b"icvp", {"backgroundImageAlias": b"\0" * 6000}),
+            (u"a", b"cmmt", u"a"), (u"b", b"cmmt", u"b")])
+    checkFile(path, model)
+
+@pytest.mark.parametrize("seed", range(6))
+def test_random_sizes_then_edit(path, seed):
+    rnd = random.Random(seed)
+    items = [(u"f%04d" % i, b"cmmt", u"c" * rnd.choice([10, 200, 1300, 2500, 5000]))
+            for i in rnd.sample(range(1000), rnd.randint(1, 300))]
+    model = build(path, items)
+    checkFile(path, model)
+    # The writer takes over from the bulk loader
+    with DSStoreWriter(path) as w:
+        for i in range(40):
+            filename = u"f%04d" % rnd.randrange(1000)
+            if (filename, b"cmmt") in model and rnd.random() < 0.5:
+                assert w.delete(filename, b"cmmt")
+                del model[(filename, b"cmmt")]
+            else:
+                record = makeRecord(filename, b"cmmt", u"d" * rnd.choice([10, 1300, 5000]))
+                w.setRecord(record)
+                model[(filename, b"cmmt")] = record.RecordData
+    checkFile(path, model)
+
+@pytest.mark.parametrize("maxRecords", [1, 2, 3, 50])
+def test_max_records(path, maxRecords):
+    records = [makeRecord(u"f%04d" % i, b"cmmt", u"c" * 10) for i in range(500)]
+    with open(path, "wb") as f:
+        f.write(bulkLoad(records, maxRecords=maxRecords))
+    checkFile(path, dict(((r.Filename, r.RecordType), r.RecordData) for r in records))
+    with DSStoreReader(path) as ds_store:
+        stack = [ds_store.BTreeMetadata.RootBlockNumber]
+        while stack:
+            node = ds_store._decodeNode(stack.pop())
+            # The last node of a level can take back its separator
+            assert node.Count <= maxRecords + 1
+            if node.P:
+                stack.extend(entry.ChildBlockNumber for entry in node.BlockData)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# ParseCache hits, misses, staleness, LRU eviction and sharing between
+# processes.  Run with py.test.
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from builder import writeDSStore
+from cache import ParseCache
+from reader import DSStoreReader
+
+@pytest.fixture
+def directory():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory)
+
+def makeFile(directory, name, count, mtime=1000000000):
+    # A whole-second mtime, so that os.utime can put it back exactly
+    path = os.path.join(directory, name)
+    writeDSStore(path, [(u"f%04d" % i, b"cmmt", u"comment") for i in range(count)])
+    os.utime(path, (mtime, mtime))
+    return path
+
+def parsed(path):
+    with DSStoreReader(path) as ds_store:
+        return list(ds_store.records())
+
+def test_miss_then_hit(directory):
+    path = makeFile(directory, "a", 50)
+    with ParseCache(os.path.join(directory, "cache")) as cache:
+        assert cache.get(path) is None
+        assert cache.records(path) == parsed(path)
+        assert cache.get(path) == parsed(path)
+        assert (cache.stats.hits, cache.stats.misses, cache.stats.stale) == (1, 2, 0)
+    # And from a new process's point of view
+    with ParseCache(os.path.join(directory, "cache")) as cache:
+        assert cache.get(path) == parsed(path)
+
+def test_stale_size_and_mtime(directory):
+    path = makeFile(directory, "a", 50)
+    with ParseCache(os.path.join(directory, "cache")) as cache:
+        cache.records(path)
+        os.utime(path, (1000000010, 1000000010))
+        assert cache.get(path) is None
+        assert cache.stats.stale == 1
+
+        # Same mtime, different size
+        cache.records(path)
+        assert cache.get(path) is not None
+        makeFile(directory, "a", 2000, mtime=1000000010)
+        assert cache.get(path) is None
+        assert cache.stats.stale == 3
+        assert len(cache.records(path)) == 2000
+
+def test_stale_fingerprint(directory):
+    # Same size and mtime, different allocator header
+    path = makeFile(directory, "a", 50)
+    with ParseCache(os.path.join(directory, "cache"), verify=True) as cache:
+        cache.records(path)
+        with open(path, "r+b") as f:
+            f.seek(24)
+            f.write(b"\x01")
+        os.utime(path, (1000000000, 1000000000))
+        assert cache.get(path) is None
+        assert cache.stats.stale == 1
+
+    # Without verify the change goes unseen
+    with ParseCache(os.path.join(directory, "cache")) as cache:
+        assert cache.get(path) is not None
+
+def test_lru_eviction(directory):
+    paths = [makeFile(directory, "f%d" % i, 20) for i in range(4)]
+    with ParseCache(os.path.join(directory, "cache"), maxBytes=1 << 30) as cache:
+        cache.records(paths[0])
+        size = cache._bytes
+    with ParseCache(os.path.join(directory, "cache"), maxBytes=3 * size) as cache:
+        cache.records(paths[1])
+        cache.records(paths[2])
+        # paths[0] is now the most recently used, so paths[1] goes
+        assert cache.get(paths[0]) is not None
+        cache.records(paths[3])
+        assert cache.stats.evictions == 1
+        assert cache.get(paths[1]) is None
+        for path in (paths[0], paths[2], paths[3]):
+            assert cache.get(path) is not None
+
+def test_hits_leave_database_unlocked(directory):
+    path = makeFile(directory, "a", 50)
+    other = makeFile(directory, "b", 50)
+    first = ParseCache(os.path.join(directory, "cache"))
+    second = ParseCache(os.path.join(directory, "cache"))
+    try:
+        first.records(path)
+        assert first.get(path) is not None
+        second._db.execute("PRAGMA busy_timeout = 100")
+        second.records(other)
+        assert second.get(other) is not None
+    finally:
+        first.close()
+        second.close()
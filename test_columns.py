@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# blobColumns against struct.unpack of each record the reader returns, over
+# several files at once.  Run with py.test; skipped without numpy.
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from builder import bulkLoad
+from columns import Layouts, blobColumns, fileColumns
+from reader import DSStoreReader
+from synthetic import generate
+from writer import makeRecord
+
+# The same layouts as Layouts, for struct
+Formats = {
+        b"Iloc": ">II8s",
+        b"fwi0": ">HHHH4s4s",
+        b"icgo": ">II",
+        b"icsp": ">II",
+        b"lssp": ">II",
+        b"dilc": ">16sII8s",
+        }
+
+def randomFile(seed):
+    # Random blobs of every layout, some of the wrong length, among records
+    # of other types, in a tree of several levels
+    rnd = random.Random(seed)
+    records = []
+    for i in range(rnd.randint(0, 400)):
+        name = u"f%04d\u00e9" % i
+        for recordType in rnd.sample(sorted(Formats), rnd.randint(0, len(Formats))):
+            size = struct.calcsize(Formats[recordType])
+            if rnd.random() < 0.1:
+                size += rnd.choice([-1, 1, 8])
+            records.append(makeRecord(name, recordType, bytes(bytearray(rnd.randrange(256) for j in range(size)))))
+        if rnd.random() < 0.3:
+            records.append(makeRecord(name, b"cmmt", u"comment"))
+    return bulkLoad(records, maxRecords=rnd.choice([3, 10, 50]))
+
+def expectedRows(ds_stores, recordType):
+    # (file, filename, fields...) for every record of recordType, unpacked
+    # one at a time
+    layout = struct.Struct(Formats[recordType])
+    rows = []
+    for fileIndex, ds_store in enumerate(ds_stores):
+        for r in ds_store.records():
+            if r.RecordType == recordType and r.DataType == "BLOB" and r.RecordData.Length == layout.size:
+                rows.append((fileIndex, r.Filename) + layout.unpack(r.RecordData.Blob))
+    return sorted(rows)
+
+def columnRows(columns, recordType):
+    dtype = Layouts[recordType]
+    fields = []
+    for name in dtype.names:
+        kind = dtype.fields[name][0].kind
+        if kind == "V":
+            fields.append([v.tobytes() for v in columns[name]])
+        elif kind == "S":
+            # numpy drops trailing NULs
+            fields.append([v.ljust(dtype.fields[name][0].itemsize, b"\0") for v in columns[name]])
+        else:
+            fields.append([int(v) for v in columns[name]])
+    return sorted(zip([int(f) for f in columns["file"]], columns["filename"], *fields))
+
+def test_matches_struct_unpack():
+    ds_stores = [DSStoreReader.fromBuffer(randomFile(seed), decodePlists=False) for seed in range(6)]
+    ds_stores.append(DSStoreReader.fromBuffer(generate(2000, seed=1), decodePlists=False))
+    result = blobColumns(ds_stores)
+    assert sorted(result) == sorted(Layouts)
+    for recordType in Layouts:
+        expected = expectedRows(ds_stores, recordType)
+        assert columnRows(result[recordType], recordType) == expected
+    assert len(expectedRows(ds_stores, b"Iloc")) > 1000
+
+def test_record_types_and_no_filenames():
+    ds_store = DSStoreReader.fromBuffer(randomFile(1), decodePlists=False)
+    result = blobColumns(ds_store, recordTypes=[b"Iloc"], filenames=False)
+    assert list(result) == [b"Iloc"]
+    assert "filename" not in result[b"Iloc"]
+    expected = expectedRows([ds_store], b"Iloc")
+    assert sorted(zip(result[b"Iloc"]["x"], result[b"Iloc"]["y"])) == sorted((row[2], row[3]) for row in expected)
+
+def test_file_columns():
+    directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        for seed in range(3):
+            paths.append(os.path.join(directory, "%d" % seed))
+            with open(paths[-1], "wb") as f:
+                f.write(randomFile(seed))
+        ds_stores = [DSStoreReader(path, decodePlists=False) for path in paths]
+        result = fileColumns(paths)
+        for recordType in Layouts:
+            assert columnRows(result[recordType], recordType) == expectedRows(ds_stores, recordType)
+        for ds_store in ds_stores:
+            ds_store.close()
+    finally:
+        shutil.rmtree(directory)
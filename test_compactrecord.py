@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# CompactRecords must round-trip, and take several times less memory than
+# the Records they come from.  Run with py.test.
+
+import sys
+
+from compactrecord import CompactRecord, compactRecords
+from construct import Container
+from dsstore import LazyPlist
+from reader import DSStoreReader
+from synthetic import generate
+
+def deepSize(roots):
+    # sys.getsizeof summed over every object reachable from roots, each
+    # counted once.  Deterministic, unlike RSS.
+    seen = set()
+    total = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, Container):
+            stack.append(obj.__keys_order__)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, CompactRecord):
+            stack.extend(getattr(obj, name) for name in CompactRecord.__slots__)
+        elif isinstance(obj, LazyPlist):
+            stack.append(obj.Blob)
+    return total
+
+def test_round_trip():
+    with DSStoreReader.fromBuffer(generate(500, seed=2)) as ds_store:
+        records = list(ds_store.records())
+    for record, compact in zip(records, compactRecords(records)):
+        assert compact.Filename == record.Filename
+        assert compact.RecordType == record.RecordType
+        assert compact.DataType == record.DataType
+        rebuilt = compact.toRecord()
+        assert rebuilt.RecordData == record.RecordData
+        assert CompactRecord.fromRecord(rebuilt) == compact
+
+def test_footprint():
+    with DSStoreReader.fromBuffer(generate(5000, seed=5)) as ds_store:
+        records = list(ds_store.records())
+    compact = compactRecords(records)
+    # Both sides hold the same plist blobs; the rest is what is saved
+    assert deepSize([records]) > 3 * deepSize([compact])
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# diff() against a brute-force comparison of two files' records, and
+# merge() against a model of the three-way merge.  Run with py.test.
+
+import os
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from builder import writeDSStore
+from diff import ADDED, CHANGED, REMOVED, diff, merge
+from dsstore import recordKey
+from reader import DSStoreReader
+from writer import DSStoreWriter, makeRecord
+
+@pytest.fixture
+def directory():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory)
+
+def reader(path):
+    return DSStoreReader(path, decodePlists=False)
+
+def contents(path):
+    # recordKey -> (DataType, RecordData)
+    with reader(path) as ds_store:
+        return dict((recordKey(r.Filename, r.RecordType), (r.DataType, r.RecordData))
+                for r in ds_store.records())
+
+def bruteForce(old, new):
+    changes = []
+    for key in sorted(set(old) | set(new)):
+        if key not in new:
+            changes.append((REMOVED, key))
+        elif key not in old:
+            changes.append((ADDED, key))
+        elif old[key] != new[key]:
+            changes.append((CHANGED, key))
+    return changes
+
+def checkDiff(oldPath, newPath):
+    old, new = contents(oldPath), contents(newPath)
+    with reader(oldPath) as a, reader(newPath) as b:
+        changes = list(diff(a, b))
+    assert [(kind, key) for kind, key, x, y in changes] == bruteForce(old, new)
+    for kind, key, x, y in changes:
+        assert (x is None) == (kind == ADDED) and (y is None) == (kind == REMOVED)
+        if x is not None:
+            assert (x.DataType, x.RecordData) == old[key]
+        if y is not None:
+            assert (y.DataType, y.RecordData) == new[key]
+    return changes
+
+def randomItems(rnd, count):
+    items = []
+    for i in rnd.sample(range(5000), count):
+        items.append((u"f%04d" % i, b"cmmt", u"c%d" % rnd.randrange(10)))
+        if rnd.random() < 0.5:
+            items.append((u"f%04d" % i, b"Iloc", b"\0" * 16))
+    return items
+
+def edit(path, rnd, edits, sizes=(3, 40)):
+    # Random sets and deletes of cmmt records, in place
+    with DSStoreWriter(path) as w:
+        for i in range(edits):
+            filename = u"f%04d" % rnd.randrange(5000)
+            if rnd.random() < 0.3:
+                w.delete(filename, b"cmmt")
+            else:
+                w.setRecord(makeRecord(filename, b"cmmt", u"e" * rnd.choice(sizes)))
+
+def test_identical(directory):
+    path = os.path.join(directory, "a")
+    writeDSStore(path, randomItems(random.Random(0), 2000))
+    assert checkDiff(path, path) == []
+
+@pytest.mark.parametrize("seed", range(5))
+def test_in_place_edits(directory, seed):
+    rnd = random.Random(seed)
+    old = os.path.join(directory, "old")
+    new = os.path.join(directory, "new")
+    writeDSStore(old, randomItems(rnd, 2000))
+    shutil.copy(old, new)
+    edit(new, rnd, rnd.choice([1, 5, 50]))
+    checkDiff(old, new)
+    checkDiff(new, old)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shifted_leaves(directory, seed):
+    # The same records, and a few changes, packed differently: bulk-loaded
+    # on one side and built up one edit at a time on the other, so that
+    # leaf boundaries fall in different places
+    rnd = random.Random(seed)
+    old = os.path.join(directory, "old")
+    new = os.path.join(directory, "new")
+    items = randomItems(rnd, 800)
+    writeDSStore(old, items)
+    writeDSStore(new, [])
+    with DSStoreWriter(new) as w:
+        for item in rnd.sample(items, len(items)):
+            w.setRecord(makeRecord(*item))
+    assert checkDiff(old, new) == []
+    edit(new, rnd, 30, sizes=(3, 40, 1300))
+    checkDiff(old, new)
+    checkDiff(new, old)
+
+def modelMerge(base, ours, theirs, prefer):
+    merged = dict(ours)
+    conflicts = []
+    for key in set(base) | set(theirs):
+        if base.get(key) == theirs.get(key):
+            continue
+        if base.get(key) != ours.get(key) and ours.get(key) != theirs.get(key):
+            conflicts.append(key)
+            if prefer == "ours":
+                continue
+        if key in theirs:
+            merged[key] = theirs[key]
+        else:
+            merged.pop(key, None)
+    return merged, sorted(conflicts)
+
+@pytest.mark.parametrize("prefer", ["ours", "theirs"])
+@pytest.mark.parametrize("seed", range(4))
+def test_merge(directory, seed, prefer):
+    rnd = random.Random(seed)
+    base, ours, theirs, out = [os.path.join(directory, name) for name in ("base", "ours", "theirs", "out")]
+    writeDSStore(base, randomItems(rnd, 1000) + [(u"shared%d" % i, b"cmmt", u"base") for i in range(4)])
+    shutil.copy(base, ours)
+    shutil.copy(base, theirs)
+    # Some edits made on both sides alike, some on one side only
+    edit(ours, random.Random(seed + 100), 60)
+    edit(theirs, random.Random(seed + 100), 30)
+    edit(theirs, rnd, 30)
+    # And conflicts: both sides add, change, or one changes and the other
+    # deletes
+    with DSStoreWriter(ours) as w:
+        w.setRecord(makeRecord(u"added", b"cmmt", u"ours"))
+        w.setRecord(makeRecord(u"shared0", b"cmmt", u"ours"))
+        w.delete(u"shared1", b"cmmt")
+        w.setRecord(makeRecord(u"shared2", b"cmmt", u"ours"))
+        w.delete(u"shared3", b"cmmt")
+    with DSStoreWriter(theirs) as w:
+        w.setRecord(makeRecord(u"added", b"cmmt", u"theirs"))
+        w.setRecord(makeRecord(u"shared0", b"cmmt", u"theirs"))
+        w.setRecord(makeRecord(u"shared1", b"cmmt", u"theirs"))
+        w.delete(u"shared2", b"cmmt")
+        w.delete(u"shared3", b"cmmt")
+    expected, expectedConflicts = modelMerge(contents(base), contents(ours), contents(theirs), prefer)
+    with reader(base) as b, reader(ours) as o, reader(theirs) as t:
+        conflicts = merge(b, o, t, out, prefer=prefer)
+    assert conflicts == expectedConflicts
+    assert [key[0] for key in conflicts if not key[0].startswith(u"f")] == [u"added", u"shared0", u"shared1", u"shared2"]
+    assert contents(out) == expected
+
+def test_merge_records_over_half_a_page(directory):
+    path = os.path.join(directory, "a")
+    out = os.path.join(directory, "out")
+    writeDSStore(path, [])
+    with DSStoreWriter(path) as w:
+        w.setRecord(makeRecord(u"a", b"cmmt", u"x" * 1300))
+        w.setRecord(makeRecord(u"b", b"cmmt", u"y" * 1300))
+    with reader(path) as a, reader(path) as b, reader(path) as c:
+        assert merge(a, b, c, out) == []
+    assert contents(out) == contents(path)
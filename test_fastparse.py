@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# The fast path must decode every node exactly as the construct schema in
+# dsstore.py does, field order included.  Run with py.test.
+
+import pytest
+from construct import Container
+
+from dsstore import DSStoreError
+from fastparse import parseBTreeNode, parseRecord
+from reader import DSStoreReader
+from synthetic import generate
+
+def assertSame(fast, reference, where):
+    # == on Containers is dict equality, which ignores the field order
+    assert type(fast) is type(reference), where
+    if isinstance(reference, Container):
+        assert fast.__keys_order__ == reference.__keys_order__, where
+        for key in reference.__keys_order__:
+            assertSame(fast[key], reference[key], "%s.%s" % (where, key))
+    elif isinstance(reference, list):
+        assert len(fast) == len(reference), where
+        for i, (a, b) in enumerate(zip(fast, reference)):
+            assertSame(a, b, "%s[%d]" % (where, i))
+    else:
+        assert fast == reference, where
+
+def checkParity(buf):
+    # Walks the whole tree, comparing each node both ways.  Returns the
+    # DataTypes seen and the depth reached.
+    fast = DSStoreReader.fromBuffer(buf)
+    reference = DSStoreReader.fromBuffer(buf, fast=False)
+    dataTypes = set()
+    levels = 0
+    stack = [(fast.BTreeMetadata.RootBlockNumber, 0)]
+    while stack:
+        blockNumber, depth = stack.pop()
+        levels = max(levels, depth)
+        node = fast._decodeNode(blockNumber)
+        assertSame(node, reference._decodeNode(blockNumber), "block %d" % blockNumber)
+        for entry in node.BlockData:
+            record = entry.Record if node.P else entry
+            dataTypes.add(record.DataType)
+        if node.P:
+            stack.extend((entry.ChildBlockNumber, depth + 1) for entry in node.BlockData)
+            stack.append((node.P, depth + 1))
+    assert levels == fast.BTreeMetadata.NumLevels
+    return dataTypes
+
+def test_multilevel():
+    dataTypes = checkParity(generate(3000, depth=3, seed=3))
+    assert dataTypes == set(["BLOB", "BOOL", "COMP", "DUTC", "TYPE", "USTR"])
+
+@pytest.mark.parametrize("recordType", [b"cmmt", b"vstl", b"modD", b"icvp", b"bwsp", b"lsvp"])
+def test_single_type(recordType):
+    # ustr, type, dutc and plist records, each filling a tree of their own
+    checkParity(generate(400, mix={recordType: 1}, depth=2, seed=1))
+
+def test_empty_tree():
+    assert checkParity(generate(0)) == set()
+
+def test_empty_buffer():
+    with pytest.raises(DSStoreError):
+        parseBTreeNode(b"")
+    with pytest.raises(DSStoreError):
+        DSStoreReader.fromBuffer(b"")
+
+def test_record_at_end_of_buffer():
+    record, pos = parseRecord(b"\0\0\0\x01\0a" + b"vstl" + b"type" + b"icnv")
+    assert record.Filename == u"a" and record.RecordData.RecordType == b"icnv" and pos == 18
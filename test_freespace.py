@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Compaction of a file bloated by edits.  Run with py.test.
+
+import os
+import shutil
+import stat
+import tempfile
+
+from builder import writeDSStore
+from freespace import analyze, compact
+from reader import DSStoreReader
+from writer import DSStoreWriter, makeRecord
+
+def records(path):
+    with DSStoreReader(path) as ds_store:
+        return [(r.Filename, r.RecordType, r.DataType, r.RecordData) for r in ds_store.records()]
+
+def test_compact_edited_file():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "DS_Store")
+        writeDSStore(path, [])
+        with DSStoreWriter(path) as w:
+            for i in range(2000):
+                w.setRecord(makeRecord(u"f%05d" % i, b"cmmt", u"c" * 40))
+        with DSStoreWriter(path) as w:
+            for i in range(2000):
+                if i % 10:
+                    w.delete(u"f%05d" % i, b"cmmt")
+        os.chmod(path, 0o640)
+        # Only root can hand the file to another owner to see it kept
+        owner = (65534, 65534) if os.geteuid() == 0 else (os.getuid(), os.getgid())
+        os.chown(path, *owner)
+        before = records(path)
+        with DSStoreReader(path) as ds_store:
+            expectedSize = analyze(ds_store)["compactedSize"]
+
+        oldSize, newSize = compact(path)
+        assert newSize < oldSize // 4
+        assert os.path.getsize(path) == newSize == expectedSize
+        assert records(path) == before
+        st = os.stat(path)
+        assert stat.S_IMODE(st.st_mode) == 0o640
+        assert (st.st_uid, st.st_gid) == owner
+        assert not os.path.exists(path + ".compact")
+
+        # The writer can carry on editing the compacted file
+        with DSStoreWriter(path) as w:
+            w.setRecord(makeRecord(u"new", b"cmmt", u"added"))
+            w.delete(u"f00000", b"cmmt")
+        after = records(path)
+        assert len(after) == len(before)
+        assert (u"new", b"cmmt") in [(r[0], r[1]) for r in after]
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Corrupt and truncated info blocks must come back as DSStoreError, without
+# the reader trying to allocate whatever a bad count asks for; range() and
+# query() must find what a walk over every record would.  Run with py.test.
+
+import struct
+
+import pytest
+
+from builder import bulkLoad
+from dsstore import DSStoreError, recordKey
+from reader import ARENA_OFFSET, DSStoreReader
+from synthetic import generate
+from writer import makeRecord
+
+def infoBlock(buf):
+    # (offset of the info block in buf, offset of its directory count)
+    pos = ARENA_OFFSET + struct.unpack_from(">I", buf, 8)[0]
+    numBlocks, = struct.unpack_from(">I", buf, pos)
+    return pos, pos + 8 + 4 * ((numBlocks + 255) // 256 * 256)
+
+def patch(buf, offset, value):
+    return buf[:offset] + struct.pack(">I", value) + buf[offset + 4:]
+
+def assertCorrupt(buf):
+    with pytest.raises(DSStoreError):
+        DSStoreReader.fromBuffer(buf)
+
+def test_intact():
+    DSStoreReader.fromBuffer(generate(100, seed=1))
+
+def test_huge_block_count():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    for numBlocks in (0x01000000, 0x10000000, 0xffffffff):
+        assertCorrupt(patch(buf, pos, numBlocks))
+
+def test_huge_directory_count():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    assertCorrupt(patch(buf, directory, 0xffffffff))
+
+def test_huge_free_list_count():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    # The directory holds only DSDB: a count, a length byte, the name and a
+    # block number, then the first free list
+    assertCorrupt(patch(buf, directory + 4 + 1 + 4 + 4, 0x10000000))
+
+def test_truncated():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    for end in range(pos, directory + 40):
+        assertCorrupt(buf[:end])
+
+def test_huge_level_count():
+    buf = generate(100, seed=1)
+    ds_store = DSStoreReader.fromBuffer(buf)
+    start, size = ds_store.block(ds_store.Directory[b"DSDB"])
+    # NumLevels follows the root block number
+    assertCorrupt(patch(buf, start + 4, 0xffffffff))
+
+def queryFile():
+    # Three levels or more of mixed-case names sharing prefixes, with
+    # several record types each
+    items = []
+    for i in range(300):
+        name = [u"Photo%03d.JPG", u"photo%03d.png", u"PHOTOS%d", u"readme%d", u"Z%d"][i % 5] % i
+        items.append(makeRecord(name, b"cmmt", u"c%d" % i))
+        if i % 3 == 0:
+            items.append(makeRecord(name, b"Iloc", b"\0" * 16))
+        if i % 7 == 0:
+            items.append(makeRecord(name, b"fwi0", b"\0" * 16))
+    buf = bulkLoad(items, maxRecords=4)
+    ds_store = DSStoreReader.fromBuffer(buf)
+    assert ds_store.BTreeMetadata.NumLevels >= 2
+    return ds_store
+
+def keys(records):
+    return [recordKey(r.Filename, r.RecordType) for r in records]
+
+@pytest.mark.parametrize("prefix", [u"photo", u"PHOTO", u"Photo0", u"photos", u"PhOtO1", u"r", u"z",
+        u"", u"a", u"q", u"zz", u"photo299"])
+@pytest.mark.parametrize("recordTypes", [None, [b"Iloc"], {b"cmmt", b"fwi0"}, []])
+def test_query_prefix(prefix, recordTypes):
+    ds_store = queryFile()
+    everything = list(ds_store.records())
+    expected = [r for r in everything if r.Filename.lower().startswith(prefix.lower()) and
+            (recordTypes is None or r.RecordType in recordTypes)]
+    assert keys(ds_store.query(prefix=prefix, recordTypes=recordTypes)) == keys(expected)
+
+def test_query_filename_and_types():
+    ds_store = queryFile()
+    everything = list(ds_store.records())
+    for filename in (u"photo001.png", u"PHOTO001.PNG", u"photo001", u"Z299", u"missing"):
+        expected = [r for r in everything if r.Filename.lower() == filename.lower()]
+        assert keys(ds_store.query(filename=filename)) == keys(expected)
+    # recordTypes alone walks the whole tree
+    assert keys(ds_store.query(recordTypes=[b"fwi0"])) == keys(r for r in everything if r.RecordType == b"fwi0")
+    assert keys(ds_store.query()) == keys(everything)
+
+def test_range():
+    ds_store = queryFile()
+    allKeys = keys(ds_store.records())
+    assert len(allKeys) > 300 and allKeys == sorted(allKeys)
+    bounds = [None, (u"", b""), (u"photo", b""), allKeys[0], allKeys[1], allKeys[150], (u"photo150.png", b"cmmt"),
+            (u"photo150.png", b"zzzz"), (u"readme", b""), allKeys[-1], (u"zzz", b"")]
+    for start in bounds:
+        for stop in bounds:
+            expected = [k for k in allKeys if (start is None or k >= start) and (stop is None or k < stop)]
+            assert keys(ds_store.range(start, stop)) == expected, (start, stop)
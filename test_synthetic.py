@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+# Synthetic files reach the depth asked for, in 4096-byte pages.  Run with
+# py.test.
+
+import pytest
+
+from reader import DSStoreReader
+from synthetic import generate
+
+def shape(data):
+    ds_store = DSStoreReader.fromBuffer(data)
+    m = ds_store.BTreeMetadata
+    return m.NumLevels + 1, m.PageSize, m.NumRecords
+
+@pytest.mark.parametrize("count, mix, depth", [
+        (10, None, 3),
+        (10, {b"Iloc": 1}, 3),
+        (100, {b"Iloc": 1}, 5),
+        (3000, None, 4),
+        ])
+def test_depth(count, mix, depth):
+    levels, pageSize, records = shape(generate(count, mix, depth=depth, seed=count))
+    assert levels >= depth
+    assert pageSize == 4096
+    assert records == count
+
+def test_depth_out_of_reach():
+    with pytest.raises(ValueError):
+        generate(5, depth=4)
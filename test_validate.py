@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# validate() on intact files and on each kind of damage it looks for,
+# checked against what DSStoreReader makes of the same bytes.  Run with
+# py.test.
+
+import os
+import shutil
+import struct
+import tempfile
+
+import pytest
+
+from dsstore import DSStoreError
+from reader import DSStoreReader
+from synthetic import generate
+from test_reader import infoBlock, patch
+from validate import isValid, validate, validateBuffer
+
+def assertCorrupt(buf, message):
+    with pytest.raises(DSStoreError) as e:
+        validateBuffer(buf)
+    assert message in str(e.value)
+    # The reader finds the same damage, on opening or when it first goes
+    # into the tree
+    with pytest.raises(DSStoreError):
+        list(DSStoreReader.fromBuffer(buf).records())
+
+def addressOffset(buf, blockNumber):
+    # Where blockNumber's entry sits in the block address table
+    pos, directory = infoBlock(buf)
+    return pos + 8 + 4 * blockNumber
+
+def test_intact():
+    directory = tempfile.mkdtemp()
+    try:
+        for count, depth in ((0, None), (100, None), (3000, 3)):
+            buf = generate(count, depth=depth, seed=1)
+            path = os.path.join(directory, "DS_Store")
+            with open(path, "wb") as f:
+                f.write(buf)
+            assert validate(path) == validateBuffer(buf)
+            assert isValid(path)
+        assert not isValid(os.path.join(directory, "missing"))
+    finally:
+        shutil.rmtree(directory)
+
+def test_fingerprint_follows_shape():
+    assert validateBuffer(generate(100, seed=1)) == validateBuffer(generate(100, seed=1))
+    assert validateBuffer(generate(100, seed=1)) != validateBuffer(generate(3000, seed=1))
+
+def test_bad_magic():
+    buf = generate(100, seed=1)
+    assertCorrupt(buf[:4] + b"Bud2" + buf[8:], "bad magic")
+
+def test_offset_backup_mismatch():
+    buf = generate(100, seed=1)
+    # InfoBlockOffsetBackup follows InfoBlockOffset and InfoBlockSize
+    offset, = struct.unpack_from(">I", buf, 8)
+    assertCorrupt(patch(buf, 16, offset + 32), "does not match its backup")
+
+def test_info_block_past_end_of_file():
+    buf = generate(100, seed=1)
+    assertCorrupt(patch(buf, 12, len(buf)), "info block")
+
+def test_address_past_end_of_file():
+    buf = generate(100, seed=1)
+    ds_store = DSStoreReader.fromBuffer(buf)
+    root = ds_store.BTreeMetadata.RootBlockNumber
+    # A 4096-byte block just past the end
+    address = (len(buf) + 4096) & ~0xfff | 12
+    assertCorrupt(patch(buf, addressOffset(buf, root), address), "block %d runs past the end of the file" % root)
+
+def test_dsdb_not_allocated():
+    buf = generate(100, seed=1)
+    dsdb = DSStoreReader.fromBuffer(buf).Directory[b"DSDB"]
+    assertCorrupt(patch(buf, addressOffset(buf, dsdb), 0), "DSDB entry names unallocated block %d" % dsdb)
+
+def test_no_dsdb():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    assertCorrupt(buf[:directory + 5] + b"XXXX" + buf[directory + 9:], "no DSDB entry")
+
+def test_root_not_allocated():
+    buf = generate(100, seed=1)
+    root = DSStoreReader.fromBuffer(buf).BTreeMetadata.RootBlockNumber
+    assertCorrupt(patch(buf, addressOffset(buf, root), 0), "B-tree root is unallocated block %d" % root)
+
+def test_huge_counts():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    assertCorrupt(patch(buf, pos, 0x10000000), "block address table")
+    assertCorrupt(patch(buf, directory, 0xffffffff), "allocator directory")
+    assertCorrupt(patch(buf, directory + 4 + 1 + 4 + 4, 0x10000000), "free list 0")
+
+def test_truncated():
+    buf = generate(100, seed=1)
+    pos, directory = infoBlock(buf)
+    for end in range(0, directory + 40):
+        with pytest.raises(DSStoreError):
+            validateBuffer(buf[:end])
+    # Cut short anywhere after the info block, the last block no longer fits
+    for end in (len(buf) - 1, len(buf) - 4096, directory + 1024):
+        with pytest.raises(DSStoreError) as e:
+            validateBuffer(buf[:end])
+        assert "runs past the end of the file" in str(e.value)
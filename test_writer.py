@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Randomized edits through DSStoreWriter, checking the whole file against a
+# model after every flush.  Run with py.test.
+
+import os
+import random
+import shutil
+import tempfile
+
+from builder import writeDSStore
+from dsstore import Record, offsetFromAddress, recordKey, sizeFromAddress
+from reader import DSStoreReader, nodeEntries
+from writer import DSStoreWriter, makeRecord
+
+def checkFile(path, model):
+    # model maps (filename, recordType) to RecordData
+    with DSStoreReader(path) as ds_store:
+        got = [(r.Filename, r.RecordType, r.RecordData) for r in ds_store.records()]
+        expected = [(key[0], key[1], model[key]) for key in sorted(model, key=lambda key: recordKey(*key))]
+        assert [g[:2] for g in got] == [e[:2] for e in expected]
+        for g, e in zip(got, expected):
+            assert g[2] == e[2]
+        m = ds_store.BTreeMetadata
+        assert m.NumRecords == len(got)
+
+        # Every leaf at depth NumLevels, and no node but the root empty
+        leafDepths = set()
+        nodes = [0]
+        def walk(blockNumber, depth):
+            nodes[0] += 1
+            records, children = nodeEntries(ds_store._decodeNode(blockNumber))
+            assert depth == 0 or records, "empty node %d" % blockNumber
+            if children is None:
+                leafDepths.add(depth)
+            else:
+                for child in children:
+                    walk(child, depth + 1)
+        walk(m.RootBlockNumber, 0)
+        assert leafDepths == set([m.NumLevels])
+        assert nodes[0] == m.NumNodes
+
+        # The header, the allocated blocks and the free lists tile the arena
+        ranges = [(0, 32)]
+        for address in ds_store.BlockAddresses[:ds_store.NumBlocks]:
+            if address:
+                ranges.append((offsetFromAddress(address), offsetFromAddress(address) + sizeFromAddress(address)))
+        for width, freeList in enumerate(ds_store.FreeList):
+            ranges.extend((offset, offset + (1 << width)) for offset in freeList.Offset)
+        ranges.sort()
+        end = 0
+        for start, stop in ranges:
+            assert start == end
+            end = stop
+        assert end == 1 << 31
+
+def randomEdits(seed, sessions, sizes):
+    rnd = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "DS_Store")
+        writeDSStore(path, [])
+        model = {}
+        for session in range(sessions):
+            with DSStoreWriter(path) as w:
+                for i in range(rnd.randint(1, 30)):
+                    if model and rnd.random() < 0.35:
+                        key = rnd.choice(sorted(model))
+                        assert w.delete(*key)
+                        del model[key]
+                        assert w.get(*key) is None
+                    else:
+                        filename = u"f%04d" % rnd.randint(0, 400)
+                        record = makeRecord(filename, b"cmmt", u"c" * rnd.choice(sizes))
+                        w.setRecord(record)
+                        model[(filename, b"cmmt")] = record.RecordData
+            checkFile(path, model)
+    finally:
+        shutil.rmtree(directory)
+
+def test_small_records():
+    for seed in range(4):
+        randomEdits(seed, 30, [0, 10, 40, 200])
+
+def test_records_over_half_a_page():
+    # Nodes of one or two records that can't be split, and records bigger
+    # than a page, which end up in blocks of their own size
+    for seed in range(8):
+        randomEdits(seed, 30, [10, 1300, 1300, 2500, 5000])
+
+def test_edited_plist_is_written_back():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "DS_Store")
+        writeDSStore(path, [(u".", b"icvp", {"iconSize": 64.0, "arrangeBy": "none"})])
+        with DSStoreWriter(path) as w:
+            record = w.get(u".", b"icvp")
+            record.RecordData.value["iconSize"] = 128.0
+            w.setRecord(record)
+        with DSStoreReader(path) as ds_store:
+            plist = ds_store.get(u".", b"icvp").RecordData
+            assert plist["iconSize"] == 128.0
+            assert sorted(plist.values()) == sorted([128.0, "none"])
+            # The construct schema writes the edit back too
+            plist.value["arrangeBy"] = "name"
+            record = ds_store.get(u".", b"icvp")
+            assert Record.parse(Record.build(record)).RecordData["arrangeBy"] == "name"
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Cheap structural checks for corruption triage, to run before a full parse.
+#
+#   python validate.py FILE...   one JSON line per file: a fingerprint or an error
+#
+# Only the BuddyAllocatorHeader, the info block and the DSDB metadata are
+# read: no B-tree node is touched.  validate() checks that
+#   - the header says Bud1 and InfoBlockOffset matches its backup,
+#   - the info block and every entry in BlockAddresses lie inside the file,
+#     and the info block's counts fit inside it,
+#   - the directory has a DSDB entry naming an allocated block, and
+#   - the B-tree's root is an allocated block,
+# and raises DSStoreError naming the first thing that is wrong.  The header
+# and info block go through the same parseHeader and parseInfoBlock as
+# DSStoreReader uses, so the two agree on what makes them corrupt.
+
+import hashlib
+import json
+import os
+import struct
+import sys
+
+from dsstore import DSStoreError, offsetFromAddress, sizeFromAddress
+from reader import ARENA_OFFSET, BTreeMetadataStruct, FileHeaderStruct, parseHeader, parseInfoBlock
+
+def _validate(read, fileSize):
+    # read(offset, length) returns bytes of the file.  Returns the
+    # fingerprint: a hash of the record count, depth, node count and the
+    # root block's number and address, which stays the same for as long as
+    # the B-tree's shape does.
+    fixed, header = parseHeader(read(0, FileHeaderStruct.size), fileSize)
+    info = read(ARENA_OFFSET + header.InfoBlockOffset, header.InfoBlockSize)
+    numBlocks, zeros, addresses, directory, freeList = parseInfoBlock(info, 0, len(info))
+    # The ends of the blocks, from offsetFromAddress and sizeFromAddress
+    # spelled out inline, as this loop is most of the time taken
+    arenaSize = fileSize - ARENA_OFFSET
+    if max([(a & 0xffffffe0) + (1 << (a & 0x1f)) for a in addresses] or [0]) > arenaSize:
+        for blockNumber, address in enumerate(addresses):
+            if address and offsetFromAddress(address) + sizeFromAddress(address) > arenaSize:
+                raise DSStoreError("block %d runs past the end of the file" % blockNumber)
+
+    def allocated(blockNumber):
+        return blockNumber < len(addresses) and addresses[blockNumber] != 0
+    if b"DSDB" not in directory:
+        raise DSStoreError("no DSDB entry in the allocator directory")
+    dsdb = directory[b"DSDB"]
+    if not allocated(dsdb):
+        raise DSStoreError("DSDB entry names unallocated block %d" % dsdb)
+    metadata = read(ARENA_OFFSET + offsetFromAddress(addresses[dsdb]), BTreeMetadataStruct.size)
+    root, levels, records, nodes, pageSize = BTreeMetadataStruct.unpack(metadata)
+    if not allocated(root):
+        raise DSStoreError("B-tree root is unallocated block %d" % root)
+    return hashlib.sha1(struct.pack(">IIIII", records, levels, nodes, root, addresses[root])).hexdigest()
+
+def validateBuffer(buf):
+    # validate() for a file already in memory
+    return _validate(lambda offset, length: buf[offset:offset + length], len(buf))
+
+def validate(path):
+    # Returns the fingerprint of the file at path, or raises DSStoreError
+    with open(path, "rb") as f:
+        def read(offset, length):
+            f.seek(offset)
+            return f.read(length)
+        return _validate(read, os.fstat(f.fileno()).st_size)
+
+def isValid(path):
+    try:
+        validate(path)
+    except (DSStoreError, EnvironmentError):
+        return False
+    return True
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        try:
+            result = {"path": path, "fingerprint": validate(path)}
+        except (DSStoreError, EnvironmentError) as e:
+            result = {"path": path, "error": str(e)}
+        print json.dumps(result, sort_keys=True)
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+# Edits a DS_Store file in place.  Only the B-tree nodes on the paths to the
+# records being changed are read; flush() writes back just those nodes, the
+# BTreeMetadata block, the allocator's info block and (if the info block had
+# to move) the header.  Space comes from, and goes back to, the file's own
+# buddy allocator, so the cost of an update follows the number of nodes it
+# touches rather than the size of the file.
+
+import struct
+from bisect import bisect_left
+
+import biplist
+from construct import Container
+
+from buddy import BuddyAllocator, buildInfoBlock
+from dsstore import (BPlistAdapter, DSStoreError, LazyPlist, Record,
+        blobData, boolData, compData, dutcData, longData, offsetFromAddress,
+        recordKey, shorData, sizeFromAddress, typeData, ustrData)
+from fastparse import DataTypeNames, PlistRecordTypes
+from reader import ARENA_OFFSET, BTreeMetadataStruct, DSStoreReader, FileHeaderStruct, nodeEntries
+
+DataTypeCodes = dict((name, code) for code, name in DataTypeNames.items())
+
+# The data type each record type is stored with, taken from the Switch in
+# dsstore.Record
+_structDataTypes = {
+        longData: b"long",
+        shorData: b"shor",
+        boolData: b"bool",
+        blobData: b"blob",
+        typeData: b"type",
+        ustrData: b"ustr",
+        compData: b"comp",
+        dutcData: b"dutc",
+        }
+RecordDataTypes = dict(
+        (recordType, b"blob" if isinstance(subcon, BPlistAdapter) else _structDataTypes[subcon])
+        for recordType, subcon in Record.subcons[-1].cases.items())
+
+def makeRecord(filename, recordType, value, dataType=None):
+    # Builds a Record container from a plain value: an integer for long,
+    # shor, bool, comp and dutc; bytes for blob (for the plist record types,
+    # either the encoded plist or an object to encode); text for ustr; a
+    # FourCharCode for type.
+    if dataType is None:
+        try:
+            dataType = RecordDataTypes[recordType]
+        except KeyError:
+            raise DSStoreError("unknown record type %r; pass dataType" % recordType)
+    if isinstance(value, (Container, LazyPlist)):
+        recordData = value
+    elif dataType == b"blob" and recordType in PlistRecordTypes:
+        if not isinstance(value, bytes):
+            value = biplist.writePlistToString(value)
+        recordData = LazyPlist(value)
+    elif dataType == b"blob":
+        recordData = Container(Length = len(value), Blob = value)
+    elif dataType == b"ustr":
+        recordData = Container(Length = len(value.encode("utf_16_be")) // 2, Data = value)
+    elif dataType == b"type":
+        recordData = Container(RecordType = value)
+    elif dataType == b"dutc":
+        recordData = Container(Ticks = value)
+    else:
+        recordData = Container(Value = value)
+    encodedName = filename.encode("utf_16_be")
+    return Container(
+            FilenameLength = len(encodedName) // 2,
+            Filename = filename,
+            RecordType = recordType,
+            DataType = DataTypeNames[dataType],
+            RecordData = recordData,
+            )
+
+def _blobBytes(recordData):
+    if isinstance(recordData, LazyPlist):
+        return recordData.encode()
+    if isinstance(recordData, Container):
+        return recordData.Blob
+    # A plain object standing in for a plist payload
+    return biplist.writePlistToString(recordData)
+
+DataEncoders = {
+        b"long": lambda d: struct.pack(">I", d.Value),
+        b"shor": lambda d: struct.pack(">I", d.Value),
+        b"bool": lambda d: struct.pack(">B", d.Value),
+        b"blob": lambda d: (lambda blob: struct.pack(">I", len(blob)) + blob)(_blobBytes(d)),
+        b"type": lambda d: d.RecordType,
+        b"ustr": lambda d: (lambda data: struct.pack(">I", len(data) // 2) + data)(d.Data.encode("utf_16_be")),
+        b"comp": lambda d: struct.pack(">Q", d.Value),
+        b"dutc": lambda d: struct.pack(">Q", d.Ticks),
+        }
+
+def buildRecord(record):
+    # The inverse of fastparse.parseRecord
+    filename = record.Filename.encode("utf_16_be")
+    dataType = DataTypeCodes[record.DataType]
+    return b"".join((struct.pack(">I", len(filename) // 2), filename,
+            record.RecordType, dataType, DataEncoders[dataType](record.RecordData)))
+
+def buildBTreeNode(records, children=None):
+    if children is None:
+        body = [buildRecord(r) for r in records]
+        p = 0
+    else:
+        body = [struct.pack(">I", child) + buildRecord(r) for child, r in zip(children, records)]
+        p = children[-1]
+    return struct.pack(">II", p, len(records)) + b"".join(body)
+
+class Node(object):
+    # A B-tree node being edited.  children is None for a leaf; otherwise it
+    # has one more entry than records, the last being the node's P pointer.
+    __slots__ = ("blockNumber", "records", "children", "keys")
+
+    def __init__(self, blockNumber, records, children):
+        self.blockNumber = blockNumber
+        self.records = records
+        self.children = children
+        self.keys = [recordKey(r.Filename, r.RecordType) for r in records]
+
+    def size(self):
+        extra = 0 if self.children is None else 4
+        return 8 + sum(len(buildRecord(r)) + extra for r in self.records)
+
+    def isLeaf(self):
+        return self.children is None
+
+class DSStoreWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self._reader = DSStoreReader(path)
+        self._file = open(path, "r+b")
+        reader = self._reader
+        self.allocator = BuddyAllocator.fromReader(reader)
+        self.Directory = dict(reader.Directory)
+        self.BTreeMetadata = Container(**reader.BTreeMetadata)
+        self.BuddyAllocatorHeader = Container(**reader.BuddyAllocatorHeader)
+        self._nodes = {}
+        self._dirty = set()
+        self._metadataDirty = False
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+            self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            # Leave the file as it was rather than write a half-done edit
+            self._file.close()
+            self._file = None
+            self._reader.close()
+
+    @property
+    def pageSize(self):
+        return self.BTreeMetadata.PageSize
+
+    # Node bookkeeping
+
+    def _node(self, blockNumber):
+        node = self._nodes.get(blockNumber)
+        if node is None:
+            records, children = nodeEntries(self._reader._decodeNode(blockNumber))
+            node = Node(blockNumber, list(records), children and list(children))
+            self._nodes[blockNumber] = node
+        return node
+
+    def _touch(self, node):
+        node.keys = [recordKey(r.Filename, r.RecordType) for r in node.records]
+        self._dirty.add(node.blockNumber)
+
+    def _newNode(self, records, children):
+        node = Node(self.allocator.allocate(self.pageSize), records, children)
+        self._nodes[node.blockNumber] = node
+        self._dirty.add(node.blockNumber)
+        self.BTreeMetadata.NumNodes += 1
+        self._metadataDirty = True
+        return node
+
+    def _dropNode(self, node):
+        self.allocator.release(node.blockNumber)
+        del self._nodes[node.blockNumber]
+        self._dirty.discard(node.blockNumber)
+        self.BTreeMetadata.NumNodes -= 1
+        self._metadataDirty = True
+
+    def _split(self, node):
+        # Cuts an oversized node into pieces that fit a page where it can.
+        # The first piece stays in node's block; returns the separators and
+        # the new nodes.  Every piece gets at least one record, so a node of
+        # fewer than three records can't be split at all: it is left whole
+        # and ([], []) returned, and flush() gives it a bigger block.
+        extra = 0 if node.isLeaf() else 4
+        sizes = [len(buildRecord(r)) + extra for r in node.records]
+        if len(sizes) < 3:
+            return [], []
+        pieces = max(2, -(-(8 + sum(sizes)) // self.pageSize))
+        target = sum(sizes) // pieces
+        cuts = []
+        used = 0
+        for i, size in enumerate(sizes[:-1]):
+            # Record i goes up as a separator only if the piece before it has
+            # something in it; stopping short of the last record keeps the
+            # final piece from being empty
+            if used and (used >= target or 8 + used + size > self.pageSize):
+                cuts.append(i)
+                used = 0
+                continue
+            used += size
+
+        records, children = node.records, node.children
+        if not cuts:
+            # One very large record at the end; cut just before it
+            cuts = [len(records) - 2]
+        bounds = [-1] + cuts + [len(records)]
+        separators = [records[i] for i in cuts]
+        newNodes = []
+        for piece in range(1, len(bounds) - 1):
+            lo, hi = bounds[piece] + 1, bounds[piece + 1]
+            newNodes.append(self._newNode(records[lo:hi],
+                    None if children is None else children[lo:hi + 1]))
+        node.records = records[:cuts[0]]
+        if children is not None:
+            node.children = children[:cuts[0] + 1]
+        self._touch(node)
+        return separators, newNodes
+
+    def _fixChild(self, parent, i):
+        # Restores child i of parent to a legal size after an edit below it,
+        # splitting it if it overflowed or merging it with a sibling if it
+        # emptied out or could share a page with one.
+        child = self._node(parent.children[i])
+        size = child.size()
+        if size > self.pageSize and len(child.records) >= 3:
+            separators, newNodes = self._split(child)
+            parent.records[i:i] = separators
+            parent.children[i + 1:i + 1] = [n.blockNumber for n in newNodes]
+            self._touch(parent)
+        elif (size < self.pageSize // 2 or not child.records) and len(parent.records) > 0:
+            j = i + 1 if i + 1 < len(parent.children) else i - 1
+            left, right = (child, self._node(parent.children[j])) if j > i else (self._node(parent.children[j]), child)
+            k = min(i, j)
+            separator = parent.records[k]
+            extra = 0 if left.isLeaf() else 4
+            merged = left.size() + right.size() - 8 + len(buildRecord(separator)) + extra
+            if merged <= self.pageSize or not child.records:
+                # Merge; an empty child has to go even when the result
+                # overflows, in which case it is split again, taking records
+                # across through the parent
+                left.records = left.records + [separator] + right.records
+                if left.children is not None:
+                    left.children = left.children + right.children
+                self._touch(left)
+                self._dropNode(right)
+                separators, newNodes = [], []
+                if merged > self.pageSize:
+                    separators, newNodes = self._split(left)
+                parent.records[k:k + 1] = separators
+                parent.children[k + 1:k + 2] = [n.blockNumber for n in newNodes]
+                self._touch(parent)
+
+    def _fixRoot(self):
+        root = self._node(self.BTreeMetadata.RootBlockNumber)
+        while root.size() > self.pageSize and len(root.records) >= 3:
+            newRoot = self._newNode([], [root.blockNumber])
+            self._fixChild(newRoot, 0)
+            self.BTreeMetadata.RootBlockNumber = newRoot.blockNumber
+            self.BTreeMetadata.NumLevels += 1
+            root = newRoot
+        while not root.isLeaf() and not root.records:
+            self.BTreeMetadata.RootBlockNumber = root.children[0]
+            self.BTreeMetadata.NumLevels -= 1
+            self._dropNode(root)
+            root = self._node(self.BTreeMetadata.RootBlockNumber)
+        self._metadataDirty = True
+
+    # Editing
+
+    def get(self, filename, recordType, default=None):
+        key = recordKey(filename, recordType)
+        node = self._node(self.BTreeMetadata.RootBlockNumber)
+        while True:
+            i = bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                return node.records[i]
+            if node.isLeaf():
+                return default
+            node = self._node(node.children[i])
+
+    def set(self, filename, recordType, value, dataType=None):
+        self.setRecord(makeRecord(filename, recordType, value, dataType))
+
+    def setRecord(self, record):
+        # Adds record, replacing any record with the same filename and type
+        if self._insert(self._node(self.BTreeMetadata.RootBlockNumber), record):
+            self.BTreeMetadata.NumRecords += 1
+        self._fixRoot()
+
+    def _insert(self, node, record):
+        key = recordKey(record.Filename, record.RecordType)
+        i = bisect_left(node.keys, key)
+        if i < len(node.keys) and node.keys[i] == key:
+            node.records[i] = record
+            self._touch(node)
+            return False
+        if node.isLeaf():
+            node.records.insert(i, record)
+            self._touch(node)
+            return True
+        added = self._insert(self._node(node.children[i]), record)
+        self._fixChild(node, i)
+        return added
+
+    def delete(self, filename, recordType):
+        # Returns whether there was such a record
+        key = recordKey(filename, recordType)
+        if not self._delete(self._node(self.BTreeMetadata.RootBlockNumber), key):
+            return False
+        self.BTreeMetadata.NumRecords -= 1
+        self._fixRoot()
+        return True
+
+    def _delete(self, node, key):
+        i = bisect_left(node.keys, key)
+        found = i < len(node.keys) and node.keys[i] == key
+        if node.isLeaf():
+            if found:
+                del node.records[i]
+                self._touch(node)
+            return found
+        if found:
+            # Replace the separator with the greatest record before it or,
+            # failing that, the least record after it
+            record = self._popEnd(self._node(node.children[i]), -1)
+            if record is None:
+                record = self._popEnd(self._node(node.children[i + 1]), 0)
+                if record is None:
+                    # Both sides are empty; fold them into one
+                    self._dropSubtree(self._node(node.children[i + 1]))
+                    del node.records[i]
+                    del node.children[i + 1]
+                    self._touch(node)
+                    self._fixChild(node, i)
+                    return True
+                node.records[i] = record
+                self._touch(node)
+                self._fixChild(node, i + 1)
+            else:
+                node.records[i] = record
+                self._touch(node)
+        elif not self._delete(self._node(node.children[i]), key):
+            return False
+        self._fixChild(node, i)
+        return True
+
+    def _popEnd(self, node, end):
+        # Removes and returns the last (end = -1) or first (end = 0) record
+        # of the subtree under node, or None if it holds no records
+        if node.isLeaf():
+            if not node.records:
+                return None
+            record = node.records.pop(end)
+            self._touch(node)
+            return record
+        i = len(node.children) - 1 if end else 0
+        record = self._popEnd(self._node(node.children[i]), end)
+        if record is None:
+            if not node.records:
+                return None
+            # The outermost child is empty; the separator next to it is
+            # the record wanted, and the empty child goes with it
+            record = node.records.pop(end)
+            self._dropSubtree(self._node(node.children.pop(end)))
+            self._touch(node)
+            return record
+        self._fixChild(node, i)
+        return record
+
+    def _dropSubtree(self, node):
+        if node.children is not None:
+            for child in node.children:
+                self._dropSubtree(self._node(child))
+        self._dropNode(node)
+
+    # Writing
+
+    def _writeBlock(self, blockNumber, data):
+        address = self.allocator.BlockAddresses[blockNumber]
+        size = sizeFromAddress(address)
+        if len(data) > size:
+            raise DSStoreError("%d bytes do not fit block %d" % (len(data), blockNumber))
+        self._file.seek(ARENA_OFFSET + offsetFromAddress(address))
+        self._file.write(data + b"\0" * (size - len(data)))
+
+    def flush(self):
+        if not self._dirty and not self._metadataDirty:
+            return
+        for blockNumber in sorted(self._dirty):
+            node = self._nodes[blockNumber]
+            data = buildBTreeNode(node.records, node.children)
+            # A node that couldn't be split (see _split) gets a block big
+            # enough for it, and goes back to a page once it fits one
+            size = sizeFromAddress(self.allocator.BlockAddresses[blockNumber])
+            if len(data) > size or (size > self.pageSize and len(data) <= self.pageSize):
+                self.allocator.release(blockNumber)
+                self.allocator.allocate(max(len(data), self.pageSize), blockNumber)
+            self._writeBlock(blockNumber, data)
+        self._dirty.clear()
+
+        m = self.BTreeMetadata
+        self._writeBlock(self.Directory[b"DSDB"], BTreeMetadataStruct.pack(m.RootBlockNumber,
+                m.NumLevels, m.NumRecords, m.NumNodes, m.PageSize))
+        self._writeInfoBlock()
+        self._metadataDirty = False
+        self._file.flush()
+
+    def _writeInfoBlock(self):
+        header = self.BuddyAllocatorHeader
+        addresses = self.allocator.BlockAddresses
+        infoBlock = None
+        for blockNumber, address in enumerate(addresses):
+            if address and offsetFromAddress(address) == header.InfoBlockOffset:
+                infoBlock = blockNumber
+                break
+        if infoBlock is None:
+            raise DSStoreError("the info block is missing from the block address table")
+
+        # Moving the info block changes the free lists it records, so keep
+        # going until what we lay out fits where it goes
+        data = buildInfoBlock(self.allocator, self.Directory, self._reader.Zeros)
+        while len(data) > sizeFromAddress(addresses[infoBlock]):
+            self.allocator.release(infoBlock)
+            self.allocator.allocate(len(data), infoBlock)
+            data = buildInfoBlock(self.allocator, self.Directory, self._reader.Zeros)
+        self._writeBlock(infoBlock, data)
+
+        address = addresses[infoBlock]
+        if (offsetFromAddress(address) != header.InfoBlockOffset or
+                sizeFromAddress(address) != header.InfoBlockSize):
+            header.InfoBlockOffset = header.InfoBlockOffsetBackup = offsetFromAddress(address)
+            header.InfoBlockSize = sizeFromAddress(address)
+            self._file.seek(0)
+            self._file.write(FileHeaderStruct.pack(1, header.Magic, header.InfoBlockOffset,
+                    header.InfoBlockSize, header.InfoBlockOffsetBackup, header.Unknown))